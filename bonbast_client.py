@@ -1,9 +1,56 @@
+import asyncio
+import os
+import random
 import re
 import time
 from typing import Any, Dict, Optional
 
 import httpx
 
+try:
+    import orjson as _json
+except ImportError:  # optional speedup
+    import json as _json
+
+# Fallback for when the $.post('/json', {param:"...."}) anchor moves;
+# either quote style in one pass.
+_PARAM_RE = re.compile(r"param\s*:\s*['\"]([^'\"]+)['\"]")
+
+
+# How far back a scan must restart to re-see a ".post(" call whose token was
+# cut off at the end of the previous chunk (the window _find_param looks at).
+_PARAM_SCAN_BACK = 6 + 128 + 512
+
+
+def _find_param(html: str, start: int = 0) -> Optional[str]:
+    # Typical pattern in the page:
+    # $.post('/json', {param:"...."}, ...
+    # Plain substring scans around that call; a token cut off at the end of
+    # `html` is not matched (its closing quote is missing).
+    i = html.find(".post(", start)
+    while i != -1:
+        j = html.find("param", i, i + 128)
+        if j != -1 and "/json" in html[i:j]:
+            rest = html[j + 5:j + 512].lstrip()
+            if rest.startswith(":"):
+                rest = rest[1:].lstrip()
+                if rest[:1] in ("'", '"'):
+                    token, sep, _ = rest[1:].partition(rest[0])
+                    if sep and token:
+                        return token
+        i = html.find(".post(", i + 6)
+    return None
+
+
+def _extract_param(html: str) -> Optional[str]:
+    param = _find_param(html)
+    if param:
+        return param
+
+    # Regex fallback in case the page layout changes.
+    m = _PARAM_RE.search(html)
+    return m.group(1) if m else None
+
 
 class BonbastClient:
     """
@@ -12,47 +59,213 @@ class BonbastClient:
     """
 
     BASE_URL = "https://bonbast.com"
+    # Set once on the client; per-request calls pass no headers (httpx
+    # already sends the form Content-Type for data= bodies).
+    HEADERS = httpx.Headers({
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) bonbast-bot/1.0",
+        "Accept": "*/*",
+        "Referer": BASE_URL + "/",
+        # No Accept-Encoding: httpx advertises exactly the codecs it can decode
+        # (gzip/deflate, plus br with the brotli extra from requirements.txt).
+    })
+
+    # Circuit breaker: after this many consecutive failed fetches, fail fast
+    # for BREAKER_RESET_S seconds, then let a single probe through.
+    BREAKER_THRESHOLD = 5
+    BREAKER_RESET_S = 30.0
+    # Attempts per fetch on transport errors (full-jitter exponential backoff)
+    MAX_ATTEMPTS = 3
+
+    PARAM_TTL_S = 3600
+    # Callers within this window (e.g. every chat due on the same minute) share one snapshot
+    DATA_TTL_S = 30.0
+
+    # One connection pool (TLS sessions, keep-alive) shared by every instance
+    _shared_client: Optional[httpx.AsyncClient] = None
 
-    def __init__(self) -> None:
-        self._client = httpx.AsyncClient(
-            base_url=self.BASE_URL,
-            timeout=httpx.Timeout(15.0, connect=10.0),
-            headers={
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) bonbast-bot/1.0",
-                "Accept": "*/*",
-                "Referer": self.BASE_URL + "/",
-            },
-            follow_redirects=True,
-        )
+    def __init__(self, param_cache_path: Optional[str] = None) -> None:
         self._param: Optional[str] = None
         self._param_ts: float = 0.0
+        self._param_lock = asyncio.Lock()
+        self._home_etag: Optional[str] = None
+        self._home_last_modified: Optional[str] = None
+        self._param_cache_path = param_cache_path
+        self._load_param_cache()
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._data: Optional[Dict[str, Any]] = None
+        self._data_ts = 0.0
+        self._fetch_lock = asyncio.Lock()
+
+    @classmethod
+    def _http(cls) -> httpx.AsyncClient:
+        c = BonbastClient._shared_client
+        if c is None or c.is_closed:
+            c = BonbastClient._shared_client = httpx.AsyncClient(
+                base_url=cls.BASE_URL,
+                timeout=httpx.Timeout(15.0, connect=10.0),
+                headers=cls.HEADERS,
+                follow_redirects=True,
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=5, keepalive_expiry=60.0),
+            )
+        return c
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        return self._http()
 
     async def aclose(self) -> None:
-        await self._client.aclose()
+        # Closes the shared pool; the next request from any instance reopens it.
+        c = BonbastClient._shared_client
+        BonbastClient._shared_client = None
+        if c is not None:
+            await c.aclose()
+
+    def _cached_param(self) -> Optional[str]:
+        # The cached param, or None when missing/expired.
+        if self._param and (time.time() - self._param_ts) < self.PARAM_TTL_S:
+            return self._param
+        return None
+
+    def _load_param_cache(self) -> None:
+        # Reuse a still-valid param from a previous run (skips one homepage GET on startup).
+        if not self._param_cache_path:
+            return
+        try:
+            with open(self._param_cache_path, "rb") as f:
+                obj = _json.loads(f.read())
+            param, ts = obj["param"], float(obj["ts"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if isinstance(param, str) and param and (time.time() - ts) < self.PARAM_TTL_S:
+            self._param = param
+            self._param_ts = ts
+
+    def _save_param_cache(self) -> None:
+        if not self._param_cache_path:
+            return
+        raw = _json.dumps({"param": self._param, "ts": self._param_ts})
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        tmp = self._param_cache_path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(raw)
+            os.replace(tmp, self._param_cache_path)
+        except OSError:
+            pass
 
     async def _get_param(self, force: bool = False) -> str:
         # Cache param for a while; refresh on failure.
-        if not force and self._param and (time.time() - self._param_ts) < 3600:
-            return self._param
+        cached = self._cached_param()
+        if not force and cached:
+            return cached
 
-        r = await self._client.get("/")
-        r.raise_for_status()
-        html = r.text
-
-        # Typical patterns in the page:
-        # $.post('/json', {param:"...."}, ...
-        m = re.search(r"\.post\(\s*['\"]\/json['\"]\s*,\s*\{\s*param\s*:\s*['\"]([^'\"]+)['\"]", html)
-        if not m:
-            # Alternate pattern fallback
-            m = re.search(r"param\s*:\s*['\"]([^'\"]+)['\"]", html)
-        if not m:
+        stale = self._param
+        async with self._param_lock:
+            # Another task may have refreshed it while we were waiting.
+            cached = self._cached_param()
+            if cached and (not force or cached != stale):
+                return cached
+            return await self._refresh_param(conditional=not force)
+
+    async def _refresh_param(self, conditional: bool = True) -> str:
+        # Conditional GET: an unchanged homepage (304) still carries our param.
+        # Skipped on forced refreshes, where the cached param was just rejected.
+        prev = self._param
+        headers: Dict[str, str] = {}
+        if conditional and prev:
+            if self._home_etag:
+                headers["If-None-Match"] = self._home_etag
+            if self._home_last_modified:
+                headers["If-Modified-Since"] = self._home_last_modified
+
+        # Streamed: the param sits near the top of the page, so stop reading
+        # (and decoding) as soon as it shows up.
+        async with self._client.stream("GET", "/", headers=headers or None) as r:
+            if r.status_code == 304 and prev:
+                self._param_ts = time.time()
+                self._save_param_cache()
+                return prev
+            r.raise_for_status()
+            self._home_etag = r.headers.get("ETag")
+            self._home_last_modified = r.headers.get("Last-Modified")
+
+            html = ""
+            param = None
+            async for chunk in r.aiter_text(chunk_size=4096):
+                start = max(0, len(html) - _PARAM_SCAN_BACK)
+                html += chunk
+                param = _find_param(html, start)
+                if param:
+                    break
+
+        if not param:
+            # Whole page read without the usual call; try the looser regex
+            param = _extract_param(html)
+        if not param:
             raise RuntimeError("Could not extract bonbast param from homepage")
 
-        self._param = m.group(1)
+        self._param = param
         self._param_ts = time.time()
-        return self._param
+        self._save_param_cache()
+        return param
+
+    def _cached_data(self) -> Optional[Dict[str, Any]]:
+        if self._data is not None and (time.time() - self._data_ts) < self.DATA_TTL_S:
+            return self._data
+        return None
 
     async def fetch(self) -> Dict[str, Any]:
+        # The returned dict is shared between callers and must not be mutated.
+        cached = self._cached_data()
+        if cached is not None:
+            return cached
+        async with self._fetch_lock:
+            cached = self._cached_data()
+            if cached is not None:
+                return cached
+            data = await self._fetch_guarded()
+            self._data = data
+            self._data_ts = time.time()
+            return data
+
+    async def _fetch_guarded(self) -> Dict[str, Any]:
+        probe = False
+        if self._failures >= self.BREAKER_THRESHOLD:
+            if time.time() < self._open_until or self._probing:
+                raise RuntimeError("Bonbast is unavailable (circuit open)")
+            # half-open: only this call talks to the origin
+            probe = self._probing = True
+
+        try:
+            data = await self._fetch_with_retry()
+        except Exception:
+            self._failures += 1
+            if self._failures >= self.BREAKER_THRESHOLD:
+                self._open_until = time.time() + self.BREAKER_RESET_S
+            raise
+        else:
+            self._failures = 0
+            return data
+        finally:
+            if probe:
+                self._probing = False
+
+    async def _fetch_with_retry(self) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            try:
+                return await self._fetch_once()
+            except httpx.TransportError:
+                attempt += 1
+                if attempt >= self.MAX_ATTEMPTS:
+                    raise
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
+
+    async def _fetch_once(self) -> Dict[str, Any]:
         param = await self._get_param(force=False)
 
         # Bonbast expects form-encoded POST
@@ -64,7 +277,7 @@ class BonbastClient:
 
         r.raise_for_status()
 
-        data = r.json()
+        data = _json.loads(r.content)
         if not isinstance(data, dict):
             raise RuntimeError("Unexpected bonbast /json response")
         return data
@@ -1,11 +1,19 @@
 import asyncio
+import contextlib
+import heapq
+import html
 import json
 import logging
 import os
 import re
+import secrets
+import sys
+import time
+import zlib
 from dataclasses import dataclass
 from datetime import datetime, time as dtime
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from zoneinfo import ZoneInfo
@@ -16,6 +24,7 @@ from telegram import (
     Update,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -26,6 +35,16 @@ from telegram.ext import (
     filters,
 )
 
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # optional speedup
+    uvloop = None
+
 from bonbast_client import BonbastClient
 from storage import Storage
 
@@ -35,7 +54,7 @@ LOG = logging.getLogger("bonbast-bot")
 
 # ---------------- Catalog ----------------
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Item:
     code: str
     fa: str
@@ -94,6 +113,25 @@ METALS: List[Item] = [
 
 CATALOG: Dict[str, Item] = {i.code: i for i in (CURRENCIES + COINS + METALS)}
 CAT_BY_CAT: Dict[str, List[Item]] = {"cur": CURRENCIES, "coin": COINS, "metal": METALS}
+CODES_BY_CAT: Dict[str, Tuple[str, ...]] = {cat: tuple(i.code for i in items) for cat, items in CAT_BY_CAT.items()}
+CODE_SET_BY_CAT: Dict[str, frozenset] = {cat: frozenset(codes) for cat, codes in CODES_BY_CAT.items()}
+
+# Resolved Bonbast JSON key per item code and price side (buy falls back to sell).
+# Keys are interned so lookups against them can short-circuit on identity.
+SELL_KEY_BY_CODE: Dict[str, str] = {c: sys.intern(i.sell_key) for c, i in CATALOG.items()}
+BUY_KEY_BY_CODE: Dict[str, str] = {c: sys.intern(i.buy_key or i.sell_key) for c, i in CATALOG.items()}
+# Canonical code string per code, for re-keying dicts decoded from stored state.
+CODE_BY_CODE: Dict[str, str] = {c: c for c in CATALOG}
+# Fixed start of each price line; the RTL mark at line start improves layout in
+# mixed RTL+numbers.
+_LINE_PREFIX: Dict[str, str] = {c: f"\u200f{i.emoji} {i.fa} : " for c, i in CATALOG.items()}
+
+# Per-category render rows: (code, sell_key, buy_key), catalog order. The label
+# part of each line comes from _LINE_PREFIX.
+RENDER_TABLE: Dict[str, List[Tuple[str, str, str]]] = {
+    cat: [(i.code, SELL_KEY_BY_CODE[i.code], BUY_KEY_BY_CODE[i.code]) for i in items]
+    for cat, items in CAT_BY_CAT.items()
+}
 
 
 # ---------------- Config helpers ----------------
@@ -107,64 +145,192 @@ def default_config() -> Dict[str, Any]:
         "sellbuy": "sell",  # sell|buy
         "threshold": 0,  # abs threshold (toman). 0 disables
         "selected": {
-            "cur": [i.code for i in CURRENCIES],
-            "coin": [i.code for i in COINS],
-            "metal": [i.code for i in METALS],
+            "cur": list(CODES_BY_CAT["cur"]),
+            "coin": list(CODES_BY_CAT["coin"]),
+            "metal": list(CODES_BY_CAT["metal"]),
         },
         # If empty -> triggers == all selected
         "triggers": {"cur": [], "coin": [], "metal": []},
     }
 
 
-def is_admin(user_id: int, admin_ids: List[int]) -> bool:
-    return user_id in admin_ids
+# Shared default for paths that only read the config (sender loop, send_for_chat).
+# Never mutate it; anything that edits a config calls default_config() for its own
+# copy (building one is ~20x cheaper than deepcopy-ing this).
+DEFAULT_CONFIG_RO: Dict[str, Any] = default_config()
 
 
-def parse_quiet(s: str) -> Optional[Tuple[dtime, dtime]]:
-    # "HH:MM-HH:MM"
-    m = re.match(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$", s)
+def _cat_map(cfg: Dict[str, Any], outer: str) -> Dict[str, List[str]]:
+    """cfg[outer] ("selected"/"triggers"), created if missing."""
+    sub = cfg.get(outer)
+    if sub is None:
+        sub = cfg[outer] = {}
+    return sub
+
+
+def _cat_list(cfg: Dict[str, Any], outer: str, cat: str) -> List[str]:
+    """cfg[outer][cat], created if missing (no throwaway defaults like setdefault)."""
+    sub = _cat_map(cfg, outer)
+    lst = sub.get(cat)
+    if lst is None:
+        lst = sub[cat] = []
+    return lst
+
+
+def _clean_cat_lists(value: Any, fallback: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """
+    selected/triggers from an imported config: known codes only, per category, in
+    their given order without repeats. Anything else (e.g. a nested list, which
+    the set-based membership checks can't hash) is dropped.
+    """
+    if not isinstance(value, dict):
+        return fallback
+    out: Dict[str, List[str]] = {}
+    for cat, known in CODE_SET_BY_CAT.items():
+        lst = value.get(cat)
+        codes: List[str] = []
+        if isinstance(lst, list):
+            for c in lst:
+                if isinstance(c, str) and c in known and c not in codes:
+                    codes.append(c)
+        out[cat] = codes
+    return out
+
+
+# chat_id -> (config, ready-to-send HTML); repeated Export taps on an unchanged config reuse it.
+_EXPORT_CACHE: Dict[int, Tuple[Dict[str, Any], str]] = {}
+
+
+def export_config(chat_id: int, cfg: Dict[str, Any]) -> str:
+    hit = _EXPORT_CACHE.get(chat_id)
+    if hit is not None and hit[0] == cfg:
+        return hit[1]
+    # quiet_parsed is derived from "quiet" (see set_quiet); export only the string,
+    # so a hand-edited export can't carry a stale window back in.
+    out = {k: v for k, v in cfg.items() if k != "quiet_parsed"}
+    if orjson is not None:
+        payload = orjson.dumps(out, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    else:
+        payload = json.dumps(out, ensure_ascii=False, indent=2)
+    # Imported configs can carry arbitrary strings; keep them from breaking the HTML
+    text = f"<pre>{html.escape(payload, quote=False)}</pre>"
+    _EXPORT_CACHE[chat_id] = (cfg, text)
+    return text
+
+
+def effective_uid(update: Update) -> int:
+    user = update.effective_user
+    return user.id if user else 0
+
+
+_QUIET_RE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$")
+
+
+# Each chat has one quiet string that rarely changes, and in_quiet() runs for every
+# chat on every tick, so the parse is memoized.
+@lru_cache(maxsize=256)
+def parse_quiet_minutes(s: str) -> Optional[Tuple[int, int]]:
+    # "HH:MM-HH:MM" -> (start, end) as minutes since midnight
+    m = _QUIET_RE.match(s)
     if not m:
         return None
     h1, m1, h2, m2 = map(int, m.groups())
     if not (0 <= h1 <= 23 and 0 <= h2 <= 23 and 0 <= m1 <= 59 and 0 <= m2 <= 59):
         return None
-    return dtime(h1, m1), dtime(h2, m2)
+    return h1 * 60 + m1, h2 * 60 + m2
 
 
-def in_quiet(now: datetime, quiet: str) -> bool:
-    if not quiet:
-        return False
-    parsed = parse_quiet(quiet)
+@lru_cache(maxsize=256)
+def parse_quiet(s: str) -> Optional[Tuple[dtime, dtime]]:
+    parsed = parse_quiet_minutes(s)
     if not parsed:
-        return False
+        return None
+    start, end = parsed
+    return dtime(*divmod(start, 60)), dtime(*divmod(end, 60))
+
+
+def set_quiet(cfg: Dict[str, Any], quiet: str) -> None:
+    """Store the quiet window string plus its parsed [start, end] minutes."""
+    cfg["quiet"] = quiet
+    parsed = parse_quiet_minutes(quiet) if quiet else None
+    if parsed:
+        cfg["quiet_parsed"] = list(parsed)
+    else:
+        cfg.pop("quiet_parsed", None)
+
+
+def quiet_window(cfg: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """(start, end) minutes since midnight, or None when quiet hours are off."""
+    parsed = cfg.get("quiet_parsed")
+    if not parsed:
+        # Configs saved before quiet_parsed existed only carry the string
+        quiet = cfg.get("quiet", "")
+        if not quiet:
+            return None
+        parsed = parse_quiet_minutes(quiet)
+        if not parsed:
+            return None
     start, end = parsed
-    t = now.time()
     if start == end:
+        return None
+    return start, end
+
+
+def in_window(t: int, window: Optional[Tuple[int, int]]) -> bool:
+    # t: minutes since midnight
+    if window is None:
         return False
+    start, end = window
     if start < end:
         return start <= t < end
     # wraps midnight
     return t >= start or t < end
 
 
+def in_quiet(now: datetime, cfg: Dict[str, Any]) -> bool:
+    return in_window(now.hour * 60 + now.minute, quiet_window(cfg))
+
+
+# Sized for a day or so of distinct price strings across the whole catalog
+@lru_cache(maxsize=4096)
+def _str_to_number(v: str) -> Optional[float]:
+    # Thousands separators go; surrounding whitespace is trimmed but interior
+    # whitespace ("1 234") still makes the value invalid, as it always has.
+    s = v.replace(",", "").strip()
+    if s == "":
+        return None
+    # The digit check decides: signed decimals ("123", "-123.45", ".5") are
+    # prices, anything else (junk, exponent/inf/nan forms) is not.
+    body = s[1:] if s[0] in "+-" else s
+    head, _, tail = body.partition(".")
+    if (head.isdecimal() or (head == "" and tail != "")) and (tail == "" or tail.isdecimal()):
+        return float(s)
+    return None
+
+
 def to_number(v: Any) -> Optional[float]:
     if v is None:
         return None
     if isinstance(v, (int, float)):
         return float(v)
     if isinstance(v, str):
-        s = v.strip().replace(",", "")
-        if s == "":
-            return None
-        try:
-            return float(s)
-        except ValueError:
-            return None
+        # Bonbast repeats the same price strings across ticks
+        return _str_to_number(v)
     return None
 
 
 def fmt_value(v: Any) -> str:
-    n = to_number(v)
+    if isinstance(v, str):
+        return _fmt_str(v)
+    return _fmt_number(to_number(v))
+
+
+@lru_cache(maxsize=4096)
+def _fmt_str(v: str) -> str:
+    return _fmt_number(_str_to_number(v))
+
+
+def _fmt_number(n: Optional[float]) -> str:
     if n is None:
         return "-"
     # decide int vs float display
@@ -174,38 +340,65 @@ def fmt_value(v: Any) -> str:
     return f"{n:,.2f}".rstrip("0").rstrip(".")
 
 
+# Parsed/formatted section values for the current Bonbast snapshot. Every chat
+# due on a tick renders from the same data dict, so chats with the same
+# selection share this work. Keeping a reference to the dict (compared by
+# identity) drops the cache as soon as a new snapshot arrives.
+_VALUES_DATA: Optional[Dict[str, Any]] = None
+_VALUES_CACHE: Dict[Tuple[str, bool, frozenset], Tuple[list, List[Optional[float]], List[str], Dict[str, float]]] = {}
+
+
+def _section_values(data: Dict[str, Any], cat: str, sell: bool, selected: frozenset) -> Tuple[list, List[Optional[float]], List[str], Dict[str, float]]:
+    global _VALUES_DATA
+    if data is not _VALUES_DATA:
+        _VALUES_CACHE.clear()
+        _VALUES_DATA = data
+    key = (cat, sell, selected)
+    hit = _VALUES_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    key_idx = 1 if sell else 2
+    rows = [r for r in RENDER_TABLE[cat] if r[0] in selected]
+    # Pull and parse the section's values in one batch before rendering
+    raws = [data.get(r[key_idx]) for r in rows]
+    nums = list(map(to_number, raws))
+    # code -> parsed value for the ones present; merged into last values in one update()
+    fresh = {r[0]: n for r, n in zip(rows, nums) if n is not None}
+    hit = (rows, nums, list(map(fmt_value, raws)), fresh)
+    _VALUES_CACHE[key] = hit
+    return hit
+
+
 def build_lines(section_items: List[Item], cfg: Dict[str, Any], data: Dict[str, Any], last: Dict[str, float]) -> Tuple[List[str], Dict[str, float], bool]:
     """
     Returns (lines, new_last_values, any_triggered_change)
+    `last` is updated in place and returned as new_last_values.
     """
     sellbuy = cfg.get("sellbuy", "sell")
     threshold = float(cfg.get("threshold", 0) or 0)
 
-    selected_codes = cfg.get("selected", {}).get(section_items[0].category, [])
-    trigger_codes = cfg.get("triggers", {}).get(section_items[0].category, []) or selected_codes
+    cat = section_items[0].category
+    # Lists keep selection order in the config; sets for the per-item membership tests
+    selected_codes = frozenset(cfg.get("selected", {}).get(cat, []))
+    trigger_codes = frozenset(cfg.get("triggers", {}).get(cat, [])) or selected_codes
 
     lines: List[str] = []
-    new_last: Dict[str, float] = dict(last)
     changed = False
 
-    for it in section_items:
-        if it.code not in selected_codes:
-            continue
+    rows, nums, value_strs, fresh = _section_values(data, cat, sellbuy == "sell", selected_codes)
 
-        key = it.sell_key if sellbuy == "sell" or not it.buy_key else it.buy_key
-        raw = data.get(key)
-        num = to_number(raw)
-        value_str = fmt_value(raw)
+    for (code, _, _), num, value_str in zip(rows, nums, value_strs):
 
         arrow = ""
-        if num is not None and it.code in last:
-            prev = last[it.code]
+        if num is not None and (prev := last.get(code)) is not None:
             if num > prev + 1e-9:
                 arrow = " ▲"
             elif num < prev - 1e-9:
                 arrow = " 🔻"
 
-            if it.code in trigger_codes:
+            # Once one trigger fired the section counts as changed; skip further checks
+            if not changed and code in trigger_codes:
                 if threshold <= 0:
                     if abs(num - prev) > 1e-9:
                         changed = True
@@ -213,15 +406,92 @@ def build_lines(section_items: List[Item], cfg: Dict[str, Any], data: Dict[str,
                     if abs(num - prev) >= threshold:
                         changed = True
 
-        # store last value (even if unchanged) to keep comparisons fresh
-        if num is not None:
-            new_last[it.code] = num
+        lines.append(_LINE_PREFIX[code] + value_str + arrow)
+
+    # store last values (even if unchanged) to keep comparisons fresh; done after the
+    # loop, which still needs the previous values
+    last.update(fresh)
+    return lines, last, changed
 
-        # RTL mark at line start improves layout in mixed RTL+numbers
-        rtl = "\u200f"
-        lines.append(f"{rtl}{it.emoji} {it.fa} : {value_str}{arrow}")
 
-    return lines, new_last, changed
+def section_delta(section_items: List[Item], cfg: Dict[str, Any], data: Dict[str, Any], last: Dict[str, float]) -> Tuple[bool, Dict[str, float]]:
+    """
+    Numbers-only counterpart of build_lines: (any_triggered_change, fresh values).
+    Renders nothing and leaves `last` alone.
+    """
+    threshold = float(cfg.get("threshold", 0) or 0)
+    cat = section_items[0].category
+    selected_codes = frozenset(cfg.get("selected", {}).get(cat, []))
+    trigger_codes = frozenset(cfg.get("triggers", {}).get(cat, [])) or selected_codes
+
+    rows, nums, _, fresh = _section_values(data, cat, cfg.get("sellbuy", "sell") == "sell", selected_codes)
+    for (code, _, _), num in zip(rows, nums):
+        if num is None or code not in trigger_codes or (prev := last.get(code)) is None:
+            continue
+        diff = abs(num - prev)
+        if (diff >= threshold) if threshold > 0 else (diff > 1e-9):
+            return True, fresh
+    return False, fresh
+
+
+# Stored last values are one flat list in CATALOG order (None = no value yet): about
+# half the JSON of per-category dicts and small enough to skip compression. The
+# signature ties a stored list to the catalog layout it was written for.
+_LAST_CODES: Tuple[str, ...] = tuple(CATALOG)
+LAST_VALUES_SIG = zlib.crc32("|".join(_LAST_CODES).encode("utf-8"))
+# CATALOG lists each category contiguously, so a category is a slice of the list
+_LAST_SLICES: Dict[str, Tuple[int, int]] = {
+    cat: (_LAST_CODES.index(codes[0]), _LAST_CODES.index(codes[0]) + len(codes))
+    for cat, codes in CODES_BY_CAT.items()
+}
+
+
+def pack_last_values(cur: Dict[str, float], coin: Dict[str, float], met: Dict[str, float]) -> List[Optional[float]]:
+    merged = {**cur, **coin, **met}
+    return [merged.get(c) for c in _LAST_CODES]
+
+
+def _last_floats(state: Dict[str, Any]) -> Tuple[Dict[str, float], Dict[str, float], Dict[str, float]]:
+    """Per-category last values (cur, coin, metal) from a chat's stored state."""
+    groups: Dict[str, Dict[str, float]] = {"cur": {}, "coin": {}, "metal": {}}
+    lv = state.get("last_values")
+    if isinstance(lv, list):
+        # A list written for another catalog layout is dropped (one tick without arrows)
+        if state.get("last_values_sig") == LAST_VALUES_SIG and len(lv) == len(_LAST_CODES):
+            for cat, (a, b) in _LAST_SLICES.items():
+                groups[cat] = {
+                    code: v if type(v) is float else float(v)
+                    for code, v in zip(CODES_BY_CAT[cat], lv[a:b])
+                    if v is not None
+                }
+    elif isinstance(lv, dict):
+        # Per-category dicts from states saved before the flat layout. Swap the decoded
+        # key strings for the catalog's own code objects, so the build_lines lookups
+        # hit on identity and the decoded copies can be freed.
+        canon = CODE_BY_CODE.get
+        for cat, sec in lv.items():
+            if cat in groups and isinstance(sec, dict):
+                groups[cat] = {canon(k, k): v if type(v) is float else float(v) for k, v in sec.items()}
+    return groups["cur"], groups["coin"], groups["metal"]
+
+
+SECTION_SEP = "_______________________"
+
+
+_STAMP_KEYS = ("year", "month", "day", "hour", "min")
+# (snapshot, stamp) for the last data dict seen; every chat on a tick shares it
+_STAMP_CACHE: Tuple[Optional[Dict[str, Any]], str] = (None, "")
+
+
+def data_stamp(data: Dict[str, Any]) -> str:
+    """Bonbast's own "Y/M/D - H:M" for a snapshot, or "" if any part is missing."""
+    global _STAMP_CACHE
+    if _STAMP_CACHE[0] is data:
+        return _STAMP_CACHE[1]
+    y, mo, d, hh, mm = [str(data.get(k, "")).strip() for k in _STAMP_KEYS]
+    stamp = f"{y}/{mo}/{d} - {hh}:{mm}" if y and mo and d and hh and mm else ""
+    _STAMP_CACHE = (data, stamp)
+    return stamp
 
 
 def now_slot_tehran(now: datetime) -> str:
@@ -230,18 +500,39 @@ def now_slot_tehran(now: datetime) -> str:
 
 # ---------------- UI keyboards ----------------
 
+@lru_cache(maxsize=16384)
+def _cb_data(*parts: Any) -> str:
+    # "action|chat_id|..." callback string; the set of combinations is small, so
+    # keyboards rebuilt after a toggle reuse one interned string per button.
+    return sys.intern("|".join(map(str, parts)))
+
+
 def kb_chat_list(chats: List[Dict[str, Any]]) -> InlineKeyboardMarkup:
+    # Refresh/Back on an unchanged chat list hands back the same markup object
+    return _kb_chat_list(tuple((ch["chat_id"], bool(ch["approved"]), ch["title"]) for ch in chats))
+
+
+@lru_cache(maxsize=16)
+def _kb_chat_list(chats: Tuple[Tuple[int, bool, str], ...]) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
-    for ch in chats:
-        icon = "✅" if ch["approved"] else "⏳"
-        title = ch["title"] or str(ch["chat_id"])
-        rows.append([InlineKeyboardButton(f"{icon} {title}", callback_data=f"sel|{ch['chat_id']}")])
+    for chat_id, approved, title in chats:
+        icon = "✅" if approved else "⏳"
+        title = title or str(chat_id)
+        rows.append([InlineKeyboardButton(f"{icon} {title}", callback_data=f"sel|{chat_id}")])
     rows.append([InlineKeyboardButton("🔄 Refresh", callback_data="refresh|0")])
     return InlineKeyboardMarkup(rows)
 
 
+# Keyboards are pure functions of a few config fields; the public kb_* builders
+# reduce cfg to a hashable key and the cached _kb_* helpers build the markup.
+
 def kb_main(chat_id: int, approved: bool, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
-    auto = "✅ فعال" if cfg.get("auto_send") else "❌ غیرفعال"
+    return _kb_main(chat_id, bool(approved), bool(cfg.get("auto_send")))
+
+
+@lru_cache(maxsize=512)
+def _kb_main(chat_id: int, approved: bool, auto_send: bool) -> InlineKeyboardMarkup:
+    auto = "✅ فعال" if auto_send else "❌ غیرفعال"
     ap = "✅ تایید شده" if approved else "⏳ نیاز به تایید"
 
     rows = [
@@ -282,14 +573,18 @@ def kb_main(chat_id: int, approved: bool, cfg: Dict[str, Any]) -> InlineKeyboard
 
 
 def kb_items(chat_id: int, cat: str, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
+    return _kb_items(chat_id, cat, frozenset(cfg.get("selected", {}).get(cat, [])))
+
+
+@lru_cache(maxsize=512)
+def _kb_items(chat_id: int, cat: str, selected: frozenset) -> InlineKeyboardMarkup:
     items = CAT_BY_CAT[cat]
-    selected = cfg.get("selected", {}).get(cat, [])
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
     for it in items:
         on = it.code in selected
         label = f"{it.fa} {'✅' if on else '❌'}"
-        row.append(InlineKeyboardButton(label, callback_data=f"togitem|{chat_id}|{cat}|{it.code}"))
+        row.append(InlineKeyboardButton(label, callback_data=_cb_data("togitem", chat_id, cat, it.code)))
         if len(row) == 2:
             rows.append(row)
             row = []
@@ -297,17 +592,30 @@ def kb_items(chat_id: int, cat: str, cfg: Dict[str, Any]) -> InlineKeyboardMarku
         rows.append(row)
 
     rows.append([
-        InlineKeyboardButton("✅ Select all", callback_data=f"all|{chat_id}|{cat}|1"),
-        InlineKeyboardButton("❌ Clear all", callback_data=f"all|{chat_id}|{cat}|0"),
+        InlineKeyboardButton("✅ Select all", callback_data=_cb_data("all", chat_id, cat, 1)),
+        InlineKeyboardButton("❌ Clear all", callback_data=_cb_data("all", chat_id, cat, 0)),
     ])
     rows.append([
-        InlineKeyboardButton("🔁 Reset order", callback_data=f"resetorder|{chat_id}|{cat}"),
-        InlineKeyboardButton("⬅️ Back", callback_data=f"panel|{chat_id}"),
+        InlineKeyboardButton("🔁 Reset order", callback_data=_cb_data("resetorder", chat_id, cat)),
+        InlineKeyboardButton("⬅️ Back", callback_data=_cb_data("panel", chat_id)),
     ])
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=512)
+def kb_export(chat_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("⬅️ Back", callback_data=f"panel|{chat_id}")],
+         [InlineKeyboardButton("Import config…", callback_data=f"import|{chat_id}")]]
+    )
+
+
 def kb_triggers(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
+    return _kb_triggers(chat_id)
+
+
+@lru_cache(maxsize=1024)
+def _kb_triggers(chat_id: int) -> InlineKeyboardMarkup:
     # choose which category first
     rows = [
         [InlineKeyboardButton("تریگر ارزها", callback_data=f"trigcat|{chat_id}|cur")],
@@ -319,8 +627,16 @@ def kb_triggers(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
 
 
 def kb_trig_items(chat_id: int, cat: str, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
-    selected = cfg.get("selected", {}).get(cat, [])
-    triggers = cfg.get("triggers", {}).get(cat, [])
+    return _kb_trig_items(
+        chat_id,
+        cat,
+        tuple(cfg.get("selected", {}).get(cat, [])),
+        frozenset(cfg.get("triggers", {}).get(cat, [])),
+    )
+
+
+@lru_cache(maxsize=512)
+def _kb_trig_items(chat_id: int, cat: str, selected: Tuple[str, ...], triggers: frozenset) -> InlineKeyboardMarkup:
     items = [CATALOG[c] for c in selected if c in CATALOG]
 
     rows: List[List[InlineKeyboardButton]] = []
@@ -328,7 +644,7 @@ def kb_trig_items(chat_id: int, cat: str, cfg: Dict[str, Any]) -> InlineKeyboard
     for it in items:
         on = it.code in triggers
         label = f"{it.fa} {'✅' if on else '❌'}"
-        row.append(InlineKeyboardButton(label, callback_data=f"togtrig|{chat_id}|{cat}|{it.code}"))
+        row.append(InlineKeyboardButton(label, callback_data=_cb_data("togtrig", chat_id, cat, it.code)))
         if len(row) == 2:
             rows.append(row)
             row = []
@@ -336,15 +652,19 @@ def kb_trig_items(chat_id: int, cat: str, cfg: Dict[str, Any]) -> InlineKeyboard
         rows.append(row)
 
     rows.append([
-        InlineKeyboardButton("✅ همه تریگر شوند", callback_data=f"trigall|{chat_id}|{cat}|1"),
-        InlineKeyboardButton("⬜️ تریگر = همه منتخب‌ها", callback_data=f"trigall|{chat_id}|{cat}|0"),
+        InlineKeyboardButton("✅ همه تریگر شوند", callback_data=_cb_data("trigall", chat_id, cat, 1)),
+        InlineKeyboardButton("⬜️ تریگر = همه منتخب‌ها", callback_data=_cb_data("trigall", chat_id, cat, 0)),
     ])
-    rows.append([InlineKeyboardButton("⬅️ Back", callback_data=f"menu|{chat_id}|triggers")])
+    rows.append([InlineKeyboardButton("⬅️ Back", callback_data=_cb_data("menu", chat_id, "triggers"))])
     return InlineKeyboardMarkup(rows)
 
 
 def kb_interval(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
-    cur = int(cfg.get("interval_min", 5) or 5)
+    return _kb_interval(chat_id, int(cfg.get("interval_min", 5) or 5))
+
+
+@lru_cache(maxsize=2048)
+def _kb_interval(chat_id: int, cur: int) -> InlineKeyboardMarkup:
     rows = [
         [
             InlineKeyboardButton("5", callback_data=f"setint|{chat_id}|5"),
@@ -367,16 +687,20 @@ def kb_quiet(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(f"فعلی: {q or 'خاموش'}", callback_data="noop|0")],
         [
-            InlineKeyboardButton("Set… (مثال 23:00-08:00)", callback_data=f"ask|{chat_id}|quiet"),
-            InlineKeyboardButton("Clear", callback_data=f"clearquiet|{chat_id}"),
+            InlineKeyboardButton("Set… (مثال 23:00-08:00)", callback_data=_cb_data("ask", chat_id, "quiet")),
+            InlineKeyboardButton("Clear", callback_data=_cb_data("clearquiet", chat_id)),
         ],
-        [InlineKeyboardButton("⬅️ Back", callback_data=f"panel|{chat_id}")],
+        [InlineKeyboardButton("⬅️ Back", callback_data=_cb_data("panel", chat_id))],
     ]
     return InlineKeyboardMarkup(rows)
 
 
 def kb_sellbuy(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
-    cur = cfg.get("sellbuy", "sell")
+    return _kb_sellbuy(chat_id, str(cfg.get("sellbuy", "sell")))
+
+
+@lru_cache(maxsize=2048)
+def _kb_sellbuy(chat_id: int, cur: str) -> InlineKeyboardMarkup:
     rows = [
         [
             InlineKeyboardButton(f"Sell {'✅' if cur=='sell' else ''}", callback_data=f"setsb|{chat_id}|sell"),
@@ -388,7 +712,12 @@ def kb_sellbuy(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
 
 
 def kb_threshold(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
-    th = cfg.get("threshold", 0) or 0
+    # str() keeps the cache key hashable whatever an imported config put there
+    return _kb_threshold(chat_id, str(cfg.get("threshold", 0) or 0))
+
+
+@lru_cache(maxsize=2048)
+def _kb_threshold(chat_id: int, th: str) -> InlineKeyboardMarkup:
     rows = [
         [InlineKeyboardButton(f"فعلی: {th}", callback_data="noop|0")],
         [
@@ -402,6 +731,161 @@ def kb_threshold(chat_id: int, cfg: Dict[str, Any]) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+# ---------------- Rate limiting ----------------
+
+class RateLimiter:
+    """
+    Spaces outgoing messages to stay under Telegram's limits: a global rate
+    (~30 msg/s) and a minimum gap per chat. After a RetryAfter, pause() holds
+    every sender until the flood wait is over.
+    """
+
+    def __init__(self, per_second: float = 30.0, per_chat_gap_s: float = 1.0) -> None:
+        self._gap = 1.0 / per_second
+        self._chat_gap = per_chat_gap_s
+        self._next_global = 0.0
+        self._next_by_chat: Dict[int, float] = {}
+        self._pause_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            now = loop.time()
+            at = max(now, self._next_global, self._pause_until, self._next_by_chat.get(chat_id, 0.0))
+            self._next_global = at + self._gap
+            self._next_by_chat[chat_id] = at + self._chat_gap
+            if len(self._next_by_chat) > 1000:
+                self._next_by_chat = {k: v for k, v in self._next_by_chat.items() if v > now}
+        if at > now:
+            await asyncio.sleep(at - now)
+        # a flood wait may have started while we were queued
+        while loop.time() < self._pause_until:
+            await asyncio.sleep(self._pause_until - loop.time())
+
+    def pause(self, seconds: float) -> None:
+        until = asyncio.get_running_loop().time() + seconds
+        self._pause_until = max(self._pause_until, until)
+
+
+async def safe_send(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs: Any) -> None:
+    limiter: RateLimiter = context.bot_data["LIMITER"]
+    await limiter.acquire(chat_id)
+    try:
+        await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except RetryAfter as e:
+        ra = e.retry_after
+        limiter.pause(ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra))
+        await limiter.acquire(chat_id)
+        await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+
+# (chat_id, message_id) -> (text, markup, monotonic time) of the last edit we made.
+# Re-sending the same content only earns a "message is not modified" error and counts
+# toward flood limits.
+_LAST_EDIT: Dict[Tuple[int, int], Tuple[Optional[str], Any, float]] = {}
+_LAST_EDIT_MAX = 500
+
+# Telegram allows roughly one edit per second per message. The first edit goes out
+# immediately; anything arriving inside the window is coalesced and only the latest
+# content is sent once the window ends.
+EDIT_MIN_INTERVAL_S = 1.0
+_EDIT_LATEST: Dict[Tuple[int, int], Tuple[Any, Optional[str], Any, Dict[str, Any]]] = {}
+_EDIT_TASKS: Dict[Tuple[int, int], "asyncio.Task[None]"] = {}
+
+
+async def _apply_edit(q: Any, key: Optional[Tuple[int, int]], text: Optional[str], markup: Any, kwargs: Dict[str, Any]) -> None:
+    prev = _LAST_EDIT.get(key) if key else None
+    if text is None:
+        # Markup-only edit keeps whatever text we last set
+        if prev is not None and prev[1] == markup:
+            return
+        text_seen = prev[0] if prev is not None else None
+    else:
+        if prev is not None and prev[0] == text and prev[1] == markup:
+            return
+        text_seen = text
+    try:
+        if text is None:
+            await q.edit_message_reply_markup(reply_markup=markup)
+        else:
+            await q.edit_message_text(text, reply_markup=markup, **kwargs)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    if key:
+        _LAST_EDIT.pop(key, None)
+        _LAST_EDIT[key] = (text_seen, markup, time.monotonic())
+        if len(_LAST_EDIT) > _LAST_EDIT_MAX:
+            del _LAST_EDIT[next(iter(_LAST_EDIT))]
+
+
+async def _trailing_edit(key: Tuple[int, int], delay: float) -> None:
+    await asyncio.sleep(delay)
+    _EDIT_TASKS.pop(key, None)
+    q, text, markup, kwargs = _EDIT_LATEST.pop(key)
+    try:
+        await _apply_edit(q, key, text, markup, kwargs)
+    except Exception:
+        LOG.exception("Deferred edit failed for %s", key)
+
+
+async def _edit(q: Any, text: Optional[str], markup: Any, **kwargs: Any) -> None:
+    msg = q.message
+    if msg is None:
+        await _apply_edit(q, None, text, markup, kwargs)
+        return
+    key = (msg.chat_id, msg.message_id)
+    prev = _LAST_EDIT.get(key)
+    wait = prev[2] + EDIT_MIN_INTERVAL_S - time.monotonic() if prev is not None else 0.0
+    if key in _EDIT_TASKS or wait > 0:
+        pending = _EDIT_LATEST.get(key)
+        if text is None and pending is not None and pending[1] is not None:
+            # Don't let a markup-only tap drop a text change still waiting to go out
+            text, kwargs = pending[1], pending[3]
+        _EDIT_LATEST[key] = (q, text, markup, kwargs)
+        if key not in _EDIT_TASKS:
+            _EDIT_TASKS[key] = asyncio.create_task(_trailing_edit(key, wait))
+        return
+    await _apply_edit(q, key, text, markup, kwargs)
+
+
+async def edit_text(q: Any, text: str, reply_markup: Any = None, **kwargs: Any) -> None:
+    await _edit(q, text, reply_markup, **kwargs)
+
+
+async def edit_markup(q: Any, reply_markup: Any) -> None:
+    await _edit(q, None, reply_markup)
+
+
+# ---------------- Callback data ----------------
+
+# Callback data stays "action|chat_id|arg|arg2" so buttons already posted keep working.
+# No button carries more than two args, so they are fixed fields ("" when absent)
+# instead of a split() list that every handler has to index and bounds-check.
+
+@dataclass(frozen=True, slots=True)
+class Cb:
+    action: str
+    chat_id: int
+    arg: str = ""
+    arg2: str = ""
+
+
+# Buttons are a small fixed set, and Cb is immutable, so decoded results (bad ones
+# included) are shared between taps.
+@lru_cache(maxsize=1024)
+def decode_cb(data: str) -> Cb:
+    action, _, rest = data.partition("|")
+    if not rest:
+        return Cb(action, 0)
+    cid, _, rest = rest.partition("|")
+    # 0 = no/invalid chat; Telegram never uses it as a chat id
+    chat_id = int(cid) if cid.removeprefix("-").isdecimal() else 0
+    arg, _, arg2 = rest.partition("|")
+    return Cb(action, chat_id, arg, arg2)
+
+
 # ---------------- Bot handlers ----------------
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -428,14 +912,12 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def cmd_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    admin_ids = context.bot_data["ADMIN_IDS"]
-    uid = update.effective_user.id if update.effective_user else 0
-    if not is_admin(uid, admin_ids):
+    if effective_uid(update) not in context.bot_data["ADMIN_ID_SET"]:
         await update.effective_message.reply_text("⛔️ دسترسی ندارید.")
         return
 
     st: Storage = context.bot_data["STORAGE"]
-    chats = st.list_chats()
+    chats = await st.alist_chats()
     if not chats:
         await update.effective_message.reply_text("هیچ چتی ثبت نشده. ربات را به گروه/کانال اضافه کنید یا /register بزنید.")
         return
@@ -452,7 +934,7 @@ async def cmd_register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     st: Storage = context.bot_data["STORAGE"]
-    st.upsert_chat(chat.id, chat.title or chat.username or str(chat.id), chat.type)
+    await st.aupsert_chat(chat.id, chat.title or chat.username or str(chat.id), chat.type)
     await update.effective_message.reply_text("✅ ثبت شد. برای تایید از /panel در پی‌وی استفاده کنید.")
 
 
@@ -466,336 +948,429 @@ async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE)
     st: Storage = context.bot_data["STORAGE"]
 
     if new_status in ("member", "administrator"):
-        st.upsert_chat(chat.id, chat.title or chat.username or str(chat.id), chat.type)
+        await st.aupsert_chat(chat.id, chat.title or chat.username or str(chat.id), chat.type)
         # DM admins (only if they started bot already)
         for aid in context.bot_data["ADMIN_IDS"]:
             try:
-                await context.bot.send_message(
-                    chat_id=aid,
-                    text=f"🆕 Bot added to: {chat.title or chat.id}\nID: {chat.id}\n/panel → approve",
+                await safe_send(
+                    context,
+                    aid,
+                    f"🆕 Bot added to: {chat.title or chat.id}\nID: {chat.id}\n/panel → approve",
                 )
             except Exception:
                 pass
     elif new_status in ("left", "kicked"):
-        st.remove_chat(chat.id)
+        await st.aremove_chat(chat.id)
+
+
+# Typed replies to an "ask"/"import" prompt. Each parser gets the text and the chat's
+# config and returns (config to save or None, reply); on_text picks one by the pending kind.
+
+def _input_interval(txt: str, cfg: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], str]:
+    # isdecimal() + range check instead of int() under try/except for bad input
+    if txt.isdecimal() and 1 <= int(txt) <= 1440:
+        cfg["interval_min"] = int(txt)
+        return cfg, "✅ Interval ذخیره شد."
+    return None, "فرمت اشتباه. مثال: 5 یا 10 یا 15"
+
+
+def _input_quiet(txt: str, cfg: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], str]:
+    if txt == "" or txt.lower() == "off":
+        set_quiet(cfg, "")
+        return cfg, "✅ ساعات سکوت خاموش شد."
+    if not parse_quiet(txt):
+        return None, "فرمت اشتباه. مثال: 23:00-08:00"
+    set_quiet(cfg, txt)
+    return cfg, "✅ ساعات سکوت ذخیره شد."
+
+
+def _input_threshold(txt: str, cfg: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], str]:
+    if txt.isdecimal():
+        cfg["threshold"] = int(txt)
+        return cfg, "✅ Threshold ذخیره شد."
+    return None, "عدد صحیح وارد کنید. مثال: 0 یا 1000"
+
+
+def _input_import(txt: str, cfg: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], str]:
+    try:
+        # orjson.JSONDecodeError subclasses ValueError like json's
+        obj = orjson.loads(txt) if orjson is not None else json.loads(txt)
+    except ValueError:
+        obj = None
+    if not isinstance(obj, dict):
+        return None, "JSON نامعتبر است."
+    # only accept known keys
+    merged = default_config()
+    merged.update({k: obj.get(k, merged.get(k)) for k in merged.keys()})
+    defaults = default_config()
+    for key in ("selected", "triggers"):
+        merged[key] = _clean_cat_lists(merged[key], defaults[key])
+    quiet = merged.get("quiet")
+    set_quiet(merged, quiet if isinstance(quiet, str) else "")
+    return merged, "✅ Import انجام شد."
+
+
+_TEXT_INPUTS: Dict[str, Callable[[str, Dict[str, Any]], Tuple[Optional[Dict[str, Any]], str]]] = {
+    "interval": _input_interval,
+    "quiet": _input_quiet,
+    "threshold": _input_threshold,
+    "import": _input_import,
+}
+
+
+# Handlers run concurrently (concurrent_updates), and every config edit is a
+# read-modify-write of the whole dict; one lock per managed chat keeps two taps
+# on the same chat from overwriting each other.
+_CHAT_LOCKS: Dict[int, asyncio.Lock] = {}
+
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = _CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = _CHAT_LOCKS[chat_id] = asyncio.Lock()
+    return lock
 
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Handle custom inputs requested by buttons
-    admin_ids = context.bot_data["ADMIN_IDS"]
-    uid = update.effective_user.id if update.effective_user else 0
-    if not is_admin(uid, admin_ids):
+    if effective_uid(update) not in context.bot_data["ADMIN_ID_SET"]:
         return
     if update.effective_chat and update.effective_chat.type != "private":
         return
 
-    pending = context.user_data.get("PENDING")
+    # (kind, chat_id) set by the button that asked for input; one reply consumes it
+    pending = context.user_data.pop("PENDING", None)
     if not pending:
         return
-
-    chat_id = int(pending["chat_id"])
-    kind = pending["kind"]
+    kind, chat_id = pending
+    parse_input = _TEXT_INPUTS.get(kind)
+    if parse_input is None:
+        return
     txt = (update.effective_message.text or "").strip()
 
     st: Storage = context.bot_data["STORAGE"]
-    ch = st.get_chat(chat_id)
-    if not ch:
-        await update.effective_message.reply_text("چت پیدا نشد.")
-        context.user_data.pop("PENDING", None)
-        return
-    cfg = ch["config"] or default_config()
+    async with chat_lock(chat_id):
+        ch = await st.aget_chat(chat_id)
+        if not ch:
+            await update.effective_message.reply_text("چت پیدا نشد.")
+            return
+        cfg = ch["config"] or default_config()
 
-    if kind == "interval":
-        try:
-            n = int(txt)
-            if n < 1 or n > 1440:
-                raise ValueError()
-            cfg["interval_min"] = n
-            st.set_config(chat_id, cfg)
-            await update.effective_message.reply_text("✅ Interval ذخیره شد.")
-        except Exception:
-            await update.effective_message.reply_text("فرمت اشتباه. مثال: 5 یا 10 یا 15")
-    elif kind == "quiet":
-        if txt == "" or txt.lower() == "off":
-            cfg["quiet"] = ""
-            st.set_config(chat_id, cfg)
-            await update.effective_message.reply_text("✅ ساعات سکوت خاموش شد.")
-        else:
-            if not parse_quiet(txt):
-                await update.effective_message.reply_text("فرمت اشتباه. مثال: 23:00-08:00")
-            else:
-                cfg["quiet"] = txt
-                st.set_config(chat_id, cfg)
-                await update.effective_message.reply_text("✅ ساعات سکوت ذخیره شد.")
-    elif kind == "threshold":
-        try:
-            n = int(txt)
-            if n < 0:
-                raise ValueError()
-            cfg["threshold"] = n
-            st.set_config(chat_id, cfg)
-            await update.effective_message.reply_text("✅ Threshold ذخیره شد.")
-        except Exception:
-            await update.effective_message.reply_text("عدد صحیح وارد کنید. مثال: 0 یا 1000")
-    elif kind == "import":
-        try:
-            obj = json.loads(txt)
-            if not isinstance(obj, dict):
-                raise ValueError()
-            # only accept known keys
-            merged = default_config()
-            merged.update({k: obj.get(k, merged.get(k)) for k in merged.keys()})
-            st.set_config(chat_id, merged)
-            await update.effective_message.reply_text("✅ Import انجام شد.")
-        except Exception:
-            await update.effective_message.reply_text("JSON نامعتبر است.")
-    context.user_data.pop("PENDING", None)
-
-    # Show panel again
-    ch2 = st.get_chat(chat_id)
+        new_cfg, reply = parse_input(txt, cfg)
+        if new_cfg is not None:
+            await st.aset_config(chat_id, new_cfg)
+            cfg = new_cfg
+    await update.effective_message.reply_text(reply)
+
+    # Show panel again (cfg already holds whatever was saved above)
     await update.effective_message.reply_text(
-        f"Control Panel: {ch2['title']}",
-        reply_markup=kb_main(chat_id, bool(ch2["approved"]), ch2["config"] or default_config()),
+        f"Control Panel: {ch['title']}",
+        reply_markup=kb_main(chat_id, bool(ch["approved"]), cfg),
     )
 
 
-async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
+# Identical taps (same user, same button) closer together than this are dropped:
+# double-taps and client retries would otherwise apply a toggle twice.
+CB_DEBOUNCE_S = 0.05
+_LAST_CB: Dict[Tuple[int, str], float] = {}
 
-    admin_ids = context.bot_data["ADMIN_IDS"]
-    uid = update.effective_user.id if update.effective_user else 0
-    if not is_admin(uid, admin_ids):
-        await q.edit_message_text("⛔️ دسترسی ندارید.")
-        return
 
+def is_repeat_tap(uid: int, data: str) -> bool:
+    now = time.monotonic()
+    key = (uid, data)
+    last = _LAST_CB.get(key)
+    _LAST_CB[key] = now
+    if len(_LAST_CB) > 1000:
+        for k in [k for k, t in _LAST_CB.items() if now - t >= CB_DEBOUNCE_S]:
+            del _LAST_CB[k]
+    return last is not None and now - last < CB_DEBOUNCE_S
+
+
+# Callback actions that act on a chat. Each handler gets the already-loaded chat
+# row and its config; on_cb looks the action up in _CB_ACTIONS instead of walking
+# an if-chain.
+
+async def _cb_panel(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    await edit_text(q, f"Control Panel: {ch['title']}", reply_markup=kb_main(cb.chat_id, bool(ch["approved"]), cfg))
+
+
+async def _cb_approve(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
     st: Storage = context.bot_data["STORAGE"]
-    data = (q.data or "")
-    parts = data.split("|")
+    ch["approved"] = not bool(ch["approved"])
+    await st.aset_approved(cb.chat_id, ch["approved"])
+    await _cb_panel(q, context, cb, ch, cfg)
 
-    action = parts[0]
 
-    if action == "noop":
-        return
+async def _cb_auto(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cfg["auto_send"] = not bool(cfg.get("auto_send"))
+    st.set_config_deferred(cb.chat_id, cfg)
+    await _cb_panel(q, context, cb, ch, cfg)
 
-    if action in ("refresh", "back"):
-        chats = st.list_chats()
-        await q.edit_message_text("Select a chat to manage:", reply_markup=kb_chat_list(chats))
-        return
 
-    if action == "help":
-        await q.edit_message_text("برای راهنما /help را بزنید.")
+async def _cb_toggle(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    what = cb.arg
+    if what == "only":
+        cfg["only_if_changed"] = not bool(cfg.get("only_if_changed"))
+        st.set_config_deferred(cb.chat_id, cfg)
+    await _cb_panel(q, context, cb, ch, cfg)
+
+
+async def _cb_menu(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    chat_id = cb.chat_id
+    menu = cb.arg
+    if menu in ("cur", "coin", "metal"):
+        await edit_text(q, f"انتخاب {menu}:", reply_markup=kb_items(chat_id, menu, cfg))
+    elif menu == "interval":
+        await edit_text(q, "Interval:", reply_markup=kb_interval(chat_id, cfg))
+    elif menu == "quiet":
+        await edit_text(q, "Quiet hours:", reply_markup=kb_quiet(chat_id, cfg))
+    elif menu == "sellbuy":
+        await edit_text(q, "Sell/Buy:", reply_markup=kb_sellbuy(chat_id, cfg))
+    elif menu == "threshold":
+        await edit_text(q, "Threshold:", reply_markup=kb_threshold(chat_id, cfg))
+    elif menu == "triggers":
+        await edit_text(q, "تریگرها:", reply_markup=kb_triggers(chat_id, cfg))
+
+
+async def _cb_trigcat(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    cat = cb.arg
+    if cat not in CODES_BY_CAT:
         return
+    await edit_text(q, f"تریگر {cat}:", reply_markup=kb_trig_items(cb.chat_id, cat, cfg))
 
-    if action == "sel":
-        chat_id = int(parts[1])
-        ch = st.get_chat(chat_id)
-        if not ch:
-            await q.edit_message_text("چت پیدا نشد.")
-            return
-        cfg = ch["config"] or default_config()
-        await q.edit_message_text(f"Control Panel: {ch['title']}", reply_markup=kb_main(chat_id, bool(ch["approved"]), cfg))
-        return
 
-    # Everything below needs chat_id
-    chat_id = int(parts[1]) if len(parts) > 1 else 0
-    ch = st.get_chat(chat_id)
-    if not ch:
-        await q.edit_message_text("چت پیدا نشد.")
+async def _cb_togitem(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cat, code = cb.arg, cb.arg2
+    if code not in CODE_SET_BY_CAT.get(cat, ()):
         return
-    cfg = ch["config"] or default_config()
+    sel = _cat_list(cfg, "selected", cat)
+    if code in sel:
+        sel.remove(code)
+    else:
+        sel.append(code)  # order = selection order
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_markup(q, kb_items(cb.chat_id, cat, cfg))
 
-    if action == "panel":
-        await q.edit_message_text(f"Control Panel: {ch['title']}", reply_markup=kb_main(chat_id, bool(ch["approved"]), cfg))
-        return
 
-    if action == "approve":
-        st.set_approved(chat_id, not bool(ch["approved"]))
-        ch2 = st.get_chat(chat_id)
-        await q.edit_message_text(
-            f"Control Panel: {ch2['title']}",
-            reply_markup=kb_main(chat_id, bool(ch2["approved"]), ch2["config"] or default_config()),
-        )
+async def _cb_resetorder(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cat = cb.arg
+    if cat not in CODES_BY_CAT:
         return
+    _cat_map(cfg, "selected")[cat] = []
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_markup(q, kb_items(cb.chat_id, cat, cfg))
 
-    if action == "auto":
-        cfg["auto_send"] = not bool(cfg.get("auto_send"))
-        st.set_config(chat_id, cfg)
-        ch2 = st.get_chat(chat_id)
-        await q.edit_message_text(
-            f"Control Panel: {ch2['title']}",
-            reply_markup=kb_main(chat_id, bool(ch2["approved"]), ch2["config"] or default_config()),
-        )
-        return
 
-    if action == "toggle":
-        what = parts[2]
-        if what == "only":
-            cfg["only_if_changed"] = not bool(cfg.get("only_if_changed"))
-            st.set_config(chat_id, cfg)
-        ch2 = st.get_chat(chat_id)
-        await q.edit_message_text(
-            f"Control Panel: {ch2['title']}",
-            reply_markup=kb_main(chat_id, bool(ch2["approved"]), ch2["config"] or default_config()),
-        )
+async def _cb_all(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cat = cb.arg
+    if cat not in CODES_BY_CAT:
         return
+    on = cb.arg2 == "1"
+    _cat_map(cfg, "selected")[cat] = list(CODES_BY_CAT[cat]) if on else []
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_markup(q, kb_items(cb.chat_id, cat, cfg))
 
-    if action == "menu":
-        menu = parts[2]
-        if menu in ("cur", "coin", "metal"):
-            await q.edit_message_text(f"انتخاب {menu}:", reply_markup=kb_items(chat_id, menu, cfg))
-            return
-        if menu == "interval":
-            await q.edit_message_text("Interval:", reply_markup=kb_interval(chat_id, cfg))
-            return
-        if menu == "quiet":
-            await q.edit_message_text("Quiet hours:", reply_markup=kb_quiet(chat_id, cfg))
-            return
-        if menu == "sellbuy":
-            await q.edit_message_text("Sell/Buy:", reply_markup=kb_sellbuy(chat_id, cfg))
-            return
-        if menu == "threshold":
-            await q.edit_message_text("Threshold:", reply_markup=kb_threshold(chat_id, cfg))
-            return
-        if menu == "triggers":
-            await q.edit_message_text("تریگرها:", reply_markup=kb_triggers(chat_id, cfg))
-            return
 
-    if action == "trigcat":
-        cat = parts[2]
-        await q.edit_message_text(f"تریگر {cat}:", reply_markup=kb_trig_items(chat_id, cat, cfg))
+async def _cb_togtrig(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cat, code = cb.arg, cb.arg2
+    if code not in CODE_SET_BY_CAT.get(cat, ()):
         return
+    tr = _cat_list(cfg, "triggers", cat)
+    if code in tr:
+        tr.remove(code)
+    else:
+        tr.append(code)
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_markup(q, kb_trig_items(cb.chat_id, cat, cfg))
 
-    if action == "togitem":
-        cat = parts[2]
-        code = parts[3]
-        sel = cfg.setdefault("selected", {}).setdefault(cat, [])
-        if code in sel:
-            sel.remove(code)
-        else:
-            sel.append(code)  # order = selection order
-        st.set_config(chat_id, cfg)
-        await q.edit_message_reply_markup(reply_markup=kb_items(chat_id, cat, cfg))
-        return
 
-    if action == "resetorder":
-        cat = parts[2]
-        cfg.setdefault("selected", {})[cat] = []
-        st.set_config(chat_id, cfg)
-        await q.edit_message_reply_markup(reply_markup=kb_items(chat_id, cat, cfg))
+async def _cb_trigall(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cat = cb.arg
+    if cat not in CODES_BY_CAT:
         return
+    mode = cb.arg2  # 1 => all selected ; 0 => empty = all selected implicitly
+    if mode == "1":
+        _cat_map(cfg, "triggers")[cat] = list(cfg.get("selected", {}).get(cat, []))
+    else:
+        _cat_map(cfg, "triggers")[cat] = []
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_markup(q, kb_trig_items(cb.chat_id, cat, cfg))
 
-    if action == "all":
-        cat = parts[2]
-        on = parts[3] == "1"
-        cfg.setdefault("selected", {})[cat] = [i.code for i in CAT_BY_CAT[cat]] if on else []
-        st.set_config(chat_id, cfg)
-        await q.edit_message_reply_markup(reply_markup=kb_items(chat_id, cat, cfg))
-        return
 
-    if action == "togtrig":
-        cat = parts[2]
-        code = parts[3]
-        tr = cfg.setdefault("triggers", {}).setdefault(cat, [])
-        if code in tr:
-            tr.remove(code)
-        else:
-            tr.append(code)
-        st.set_config(chat_id, cfg)
-        await q.edit_message_reply_markup(reply_markup=kb_trig_items(chat_id, cat, cfg))
+async def _cb_setint(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    if not cb.arg.isdecimal():
         return
+    cfg["interval_min"] = int(cb.arg)
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_text(q, "Interval:", reply_markup=kb_interval(cb.chat_id, cfg))
 
-    if action == "trigall":
-        cat = parts[2]
-        mode = parts[3]  # 1 => all selected ; 0 => empty = all selected implicitly
-        if mode == "1":
-            cfg.setdefault("triggers", {})[cat] = list(cfg.get("selected", {}).get(cat, []))
-        else:
-            cfg.setdefault("triggers", {})[cat] = []
-        st.set_config(chat_id, cfg)
-        await q.edit_message_reply_markup(reply_markup=kb_trig_items(chat_id, cat, cfg))
-        return
 
-    if action == "setint":
-        n = int(parts[2])
-        cfg["interval_min"] = n
-        st.set_config(chat_id, cfg)
-        await q.edit_message_text("Interval:", reply_markup=kb_interval(chat_id, cfg))
-        return
+async def _cb_clearquiet(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    set_quiet(cfg, "")
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_text(q, "Quiet hours:", reply_markup=kb_quiet(cb.chat_id, cfg))
 
-    if action == "clearquiet":
-        cfg["quiet"] = ""
-        st.set_config(chat_id, cfg)
-        await q.edit_message_text("Quiet hours:", reply_markup=kb_quiet(chat_id, cfg))
-        return
 
-    if action == "setsb":
-        mode = parts[2]
-        cfg["sellbuy"] = "buy" if mode == "buy" else "sell"
-        st.set_config(chat_id, cfg)
-        await q.edit_message_text("Sell/Buy:", reply_markup=kb_sellbuy(chat_id, cfg))
+async def _cb_setsb(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    cfg["sellbuy"] = "buy" if cb.arg == "buy" else "sell"
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_text(q, "Sell/Buy:", reply_markup=kb_sellbuy(cb.chat_id, cfg))
+
+
+async def _cb_setth(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    if not cb.arg.isdecimal():
         return
+    cfg["threshold"] = int(cb.arg)
+    st.set_config_deferred(cb.chat_id, cfg)
+    await edit_text(q, "Threshold:", reply_markup=kb_threshold(cb.chat_id, cfg))
 
-    if action == "setth":
-        n = int(parts[2])
-        cfg["threshold"] = n
-        st.set_config(chat_id, cfg)
-        await q.edit_message_text("Threshold:", reply_markup=kb_threshold(chat_id, cfg))
+
+_ASK_PROMPTS = {
+    "interval": "یک عدد دقیقه بفرستید. مثال: 5",
+    "quiet": "فرمت: 23:00-08:00  (یا OFF برای خاموش)",
+    "threshold": "یک عدد (تومان) بفرستید. مثال: 1000  (یا 0 برای خاموش)",
+}
+
+
+async def _cb_ask(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    kind = cb.arg
+    prompt = _ASK_PROMPTS.get(kind)
+    if prompt is None:
         return
+    # prompt user to type next message
+    context.user_data["PENDING"] = (kind, cb.chat_id)
+    await edit_text(q, prompt)
+
+
+async def _cb_export(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    await edit_text(q, export_config(cb.chat_id, cfg), parse_mode=ParseMode.HTML, reply_markup=kb_export(cb.chat_id))
+
+
+async def _cb_import(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    context.user_data["PENDING"] = ("import", cb.chat_id)
+    await edit_text(q, "JSON کانفیگ را همینجا Paste کنید:")
+
+
+async def _cb_send(q: Any, context: ContextTypes.DEFAULT_TYPE, cb: Cb, ch: Dict[str, Any], cfg: Dict[str, Any]) -> None:
+    await edit_text(q, "در حال ارسال…")
+    await send_for_chat(context, cb.chat_id, force=True, test=(cb.action == "test"))
+    await q.message.reply_text(
+        f"Control Panel: {ch['title']}",
+        reply_markup=kb_main(cb.chat_id, bool(ch["approved"]), cfg),
+    )
+
+
+_CB_ACTIONS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "sel": _cb_panel,
+    "panel": _cb_panel,
+    "approve": _cb_approve,
+    "auto": _cb_auto,
+    "toggle": _cb_toggle,
+    "menu": _cb_menu,
+    "trigcat": _cb_trigcat,
+    "togitem": _cb_togitem,
+    "resetorder": _cb_resetorder,
+    "all": _cb_all,
+    "togtrig": _cb_togtrig,
+    "trigall": _cb_trigall,
+    "setint": _cb_setint,
+    "clearquiet": _cb_clearquiet,
+    "setsb": _cb_setsb,
+    "setth": _cb_setth,
+    "ask": _cb_ask,
+    "export": _cb_export,
+    "import": _cb_import,
+    "test": _cb_send,
+    "sendnow": _cb_send,
+}
+
+
+# Actions that don't refer to a chat.
+
+async def _cb_noop(q: Any, context: ContextTypes.DEFAULT_TYPE) -> None:
+    return
+
+
+async def _cb_chat_list(q: Any, context: ContextTypes.DEFAULT_TYPE) -> None:
+    st: Storage = context.bot_data["STORAGE"]
+    chats = await st.alist_chats()
+    await edit_text(q, "Select a chat to manage:", reply_markup=kb_chat_list(chats))
 
-    if action == "ask":
-        kind = parts[2]
-        # prompt user to type next message
-        if kind == "interval":
-            context.user_data["PENDING"] = {"chat_id": chat_id, "kind": "interval"}
-            await q.edit_message_text("یک عدد دقیقه بفرستید. مثال: 5")
-            return
-        if kind == "quiet":
-            context.user_data["PENDING"] = {"chat_id": chat_id, "kind": "quiet"}
-            await q.edit_message_text("فرمت: 23:00-08:00  (یا OFF برای خاموش)")
-            return
-        if kind == "threshold":
-            context.user_data["PENDING"] = {"chat_id": chat_id, "kind": "threshold"}
-            await q.edit_message_text("یک عدد (تومان) بفرستید. مثال: 1000  (یا 0 برای خاموش)")
-            return
 
-    if action == "export":
-        payload = json.dumps(cfg, ensure_ascii=False, indent=2)
-        await q.edit_message_text(f"<pre>{payload}</pre>", parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("⬅️ Back", callback_data=f"panel|{chat_id}")],
-             [InlineKeyboardButton("Import config…", callback_data=f"import|{chat_id}")]]
-        ))
+async def _cb_help(q: Any, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await edit_text(q, "برای راهنما /help را بزنید.")
+
+
+_CB_GLOBAL_ACTIONS: Dict[str, Callable[..., Awaitable[None]]] = {
+    "noop": _cb_noop,
+    "refresh": _cb_chat_list,
+    "back": _cb_chat_list,
+    "help": _cb_help,
+}
+
+
+async def on_cb(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    uid = effective_uid(update)
+    if is_repeat_tap(uid, q.data or ""):
         return
 
-    if action == "import":
-        context.user_data["PENDING"] = {"chat_id": chat_id, "kind": "import"}
-        await q.edit_message_text("JSON کانفیگ را همینجا Paste کنید:")
+    if uid not in context.bot_data["ADMIN_ID_SET"]:
+        await edit_text(q, "⛔️ دسترسی ندارید.")
         return
 
-    if action in ("test", "sendnow"):
-        await q.edit_message_text("در حال ارسال…")
-        await send_for_chat(context, chat_id, force=True, test=(action == "test"))
-        ch2 = st.get_chat(chat_id)
-        await q.message.reply_text(
-            f"Control Panel: {ch2['title']}",
-            reply_markup=kb_main(chat_id, bool(ch2["approved"]), ch2["config"] or default_config()),
-        )
+    cb = decode_cb(q.data or "")
+    global_handler = _CB_GLOBAL_ACTIONS.get(cb.action)
+    if global_handler is not None:
+        await global_handler(q, context)
+        return
+
+    handler = _CB_ACTIONS.get(cb.action)
+    if handler is None or not cb.chat_id:
         return
 
+    # Everything below needs chat_id
+    st: Storage = context.bot_data["STORAGE"]
+    async with chat_lock(cb.chat_id):
+        ch = await st.aget_chat(cb.chat_id)
+        if not ch:
+            await edit_text(q, "چت پیدا نشد.")
+            return
+        cfg = ch["config"] or default_config()
+        await handler(q, context, cb, ch, cfg)
+
 
 # ---------------- Sending loop ----------------
 
-async def send_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, force: bool, test: bool = False) -> None:
+async def send_for_chat(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: int,
+    force: bool,
+    test: bool = False,
+    data: Optional[Dict[str, Any]] = None,
+) -> None:
+    # data: the sender loop passes the tick's snapshot so every chat renders the same one
     st: Storage = context.bot_data["STORAGE"]
-    client: BonbastClient = context.bot_data["CLIENT"]
 
-    ch = st.get_chat(chat_id)
+    ch = await st.aget_chat(chat_id)
     if not ch:
         return
     approved = bool(ch["approved"])
-    cfg = ch["config"] or default_config()
+    cfg = ch["config"] or DEFAULT_CONFIG_RO
     state = ch["state"] or {}
 
     if not force:
@@ -803,37 +1378,40 @@ async def send_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, force:
             return
 
     now = datetime.now(TZ)
-    if not force and in_quiet(now, cfg.get("quiet", "")):
-        return
-
-    data = await client.fetch()
+    # For scheduled sends: avoid duplicates within same minute slot. Checked before
+    # any fetching or parsing, which a skipped send would throw away.
+    slot = now_slot_tehran(now)
+    if not force:
+        if state.get("last_slot") == slot or in_quiet(now, cfg):
+            return
 
-    # date/time from bonbast json if present
-    try:
-        y = str(data.get("year", "")).strip()
-        mo = str(data.get("month", "")).strip()
-        d = str(data.get("day", "")).strip()
-        hh = str(data.get("hour", "")).strip()
-        mm = str(data.get("min", "")).strip()
-        if y and mo and d and hh and mm:
-            dt_header = f"{y}/{mo}/{d} - {hh}:{mm}"
-        else:
-            dt_header = now.strftime("%Y/%m/%d - %H:%M")
-    except Exception:
-        dt_header = now.strftime("%Y/%m/%d - %H:%M")
+    if data is None:
+        client: BonbastClient = context.bot_data["CLIENT"]
+        data = await client.fetch()
 
-    last_values = state.get("last_values", {})
-    if not isinstance(last_values, dict):
-        last_values = {}
+    # For per-category comparisons
+    last_cur, last_coin, last_met = _last_floats(state)
+
+    # With only_if_changed most ticks post nothing; settle that from the numbers
+    # alone and only render lines when a trigger fired.
+    if cfg.get("only_if_changed") and not force:
+        deltas = [
+            section_delta(items, cfg, data, last)
+            for items, last in ((CURRENCIES, last_cur), (COINS, last_coin), (METALS, last_met))
+        ]
+        if not any(changed for changed, _ in deltas):
+            for last, (_, fresh) in zip((last_cur, last_coin, last_met), deltas):
+                last.update(fresh)
+            state["last_values"] = pack_last_values(last_cur, last_coin, last_met)
+            state["last_values_sig"] = LAST_VALUES_SIG
+            state["last_slot"] = slot
+            st.set_state_deferred(chat_id, state)
+            return
 
     # Build message
     rtl = "\u200f"
-    header = f"{rtl}✅ نرخ لحظه‌ای ارز و سکه\n{rtl}📅 {dt_header}\n"
-
-    # For per-category comparisons
-    last_cur = {k: float(v) for k, v in last_values.get("cur", {}).items()} if isinstance(last_values.get("cur"), dict) else {}
-    last_coin = {k: float(v) for k, v in last_values.get("coin", {}).items()} if isinstance(last_values.get("coin"), dict) else {}
-    last_met = {k: float(v) for k, v in last_values.get("metal", {}).items()} if isinstance(last_values.get("metal"), dict) else {}
+    # date/time from bonbast json if present
+    dt_header = data_stamp(data) or now.strftime("%Y/%m/%d - %H:%M")
 
     cur_lines, new_cur, cur_changed = build_lines(CURRENCIES, cfg, data, last_cur)
     coin_lines, new_coin, coin_changed = build_lines(COINS, cfg, data, last_coin)
@@ -844,72 +1422,154 @@ async def send_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, force:
     if cfg.get("only_if_changed"):
         should_send = cur_changed or coin_changed or met_changed
 
-    # Always refresh last values so comparisons stay correct
-    new_last_values = {
-        "cur": new_cur,
-        "coin": new_coin,
-        "metal": new_met,
-    }
-
-    # For scheduled sends: avoid duplicates within same minute slot
-    slot = now_slot_tehran(now)
-    if not force:
-        if state.get("last_slot") == slot:
-            return
+    # All lines go through a single join: two blank lines after the header, one
+    # blank line plus a separator before the coin and metal sections.
+    out: List[str] = [f"{rtl}✅ نرخ لحظه‌ای ارز و سکه", f"{rtl}📅 {dt_header}"]
+    first = True
+    for lines, sep in ((cur_lines, False), (coin_lines, True), (met_lines, True)):
+        if not lines:
+            continue
+        out.append("")
+        if first:
+            out.append("")
+            first = False
+        if sep:
+            out.append(SECTION_SEP)
+        out.extend(lines)
+    msg = "\n".join(out)
 
-    state["last_values"] = new_last_values
+    # Always refresh last values so comparisons stay correct
+    state["last_values"] = pack_last_values(new_cur, new_coin, new_met)
+    state["last_values_sig"] = LAST_VALUES_SIG
     state["last_slot"] = slot
-    st.set_state(chat_id, state)
+    # Left behind by an earlier duplicate-post check
+    state.pop("last_text_crc", None)
+    st.set_state_deferred(chat_id, state)
 
     if not should_send and not force:
         return
 
-    parts: List[str] = [header]
-    if cur_lines:
-        parts.append("\n".join(cur_lines))
-    if coin_lines:
-        parts.append("_______________________\n" + "\n".join(coin_lines))
-    if met_lines:
-        parts.append("_______________________\n" + "\n".join(met_lines))
+    target = context.bot_data["ADMIN_IDS"][0] if test else chat_id
+    await safe_send(context, target, msg)
 
-    msg = "\n\n".join(parts).strip()
 
-    target = context.bot_data["ADMIN_IDS"][0] if test else chat_id
-    await context.bot.send_message(chat_id=target, text=msg)
+# Sleep this much past the minute boundary to absorb event-loop clock resolution
+TICK_SLACK_S = 0.05
+# Concurrent scheduled sends per tick (pacing itself is done by RateLimiter)
+SEND_CONCURRENCY = 25
+
+
+def next_due(tick: int, interval: int) -> int:
+    """Next minute boundary after `tick` whose Tehran minute-of-hour is a multiple of `interval`."""
+    minute = datetime.fromtimestamp(tick, TZ).minute
+    return tick + (min((minute // interval + 1) * interval, 60) - minute) * 60
+
+
+def build_schedule(chats: List[Dict[str, Any]], base: int) -> Tuple[List[Tuple[int, int, int]], Dict[int, Optional[Tuple[int, int]]]]:
+    """Heap of (due tick, chat_id, interval) for approved auto-send chats, plus their quiet windows."""
+    heap: List[Tuple[int, int, int]] = []
+    quiet: Dict[int, Optional[Tuple[int, int]]] = {}
+    for ch in chats:
+        try:
+            cfg = ch["config"] or DEFAULT_CONFIG_RO
+            if not ch["approved"] or not cfg.get("auto_send"):
+                continue
+            interval = int(cfg.get("interval_min", 5) or 5)
+            if interval < 1:
+                interval = 5
+            heap.append((next_due(base, interval), ch["chat_id"], interval))
+            quiet[ch["chat_id"]] = quiet_window(cfg)
+        except Exception as e:
+            LOG.exception("sender_loop chat error: %s", e)
+    heapq.heapify(heap)
+    return heap, quiet
 
 
 async def sender_loop(app: Application) -> None:
-    # Align to next minute boundary
-    while True:
-        now = datetime.now(TZ)
-        sleep_s = 60 - now.second - (now.microsecond / 1_000_000)
-        if sleep_s < 0.1:
-            sleep_s = 0.1
-        await asyncio.sleep(sleep_s)
-
-        st: Storage = app.bot_data["STORAGE"]
-        chats = st.list_chats()
-        if not chats:
-            continue
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
 
-        now = datetime.now(TZ)
-        for ch in chats:
+    async def send_one(chat_id: int, data: Dict[str, Any]) -> None:
+        async with sem:
             try:
-                cfg = ch["config"] or default_config()
-                if not ch["approved"] or not cfg.get("auto_send"):
-                    continue
-                interval = int(cfg.get("interval_min", 5) or 5)
-                if interval < 1:
-                    interval = 5
-                if now.minute % interval != 0:
-                    continue
-                if in_quiet(now, cfg.get("quiet", "")):
-                    continue
-                await send_for_chat(app.bot_data["CTX"], ch["chat_id"], force=False)
-                await asyncio.sleep(0.2)
+                await send_for_chat(app.bot_data["CTX"], chat_id, force=False, data=data)
             except Exception as e:
                 LOG.exception("sender_loop chat error: %s", e)
 
+    # Warm the chat cache and the Bonbast token/snapshot side by side, so neither
+    # the first tick nor the first panel opened after a restart pays for them.
+    st: Storage = app.bot_data["STORAGE"]
+    client: BonbastClient = app.bot_data["CLIENT"]
+    for res in await asyncio.gather(st.alist_chats(), client.fetch(), return_exceptions=True):
+        if isinstance(res, Exception):
+            LOG.warning("Startup warm-up failed: %s", res)
+
+    # Chats are woken from a heap of (due tick, chat_id, interval) instead of scanning
+    # every chat every minute. Ticks are minute boundaries in plain epoch seconds
+    # (Tehran's UTC offset is a whole number of minutes), and the tick time is the
+    # boundary itself, so an early wakeup can't land on the previous minute.
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    st.on_schedule_change = lambda: loop.call_soon_threadsafe(changed.set)
+
+    heap: List[Tuple[int, int, int]] = []
+    quiet: Dict[int, Optional[Tuple[int, int]]] = {}
+    last_tick = int(time.time()) // 60 * 60
+    stale = True
+    try:
+        while True:
+            if stale:
+                changed.clear()
+                stale = False
+                try:
+                    # Read-only use, so the cached rows do (no SQLite round trip)
+                    chats = await st.alist_chats_cached()
+                except Exception as e:
+                    LOG.exception("sender_loop schedule error: %s", e)
+                    chats = []
+                # Only a boundary passed within the last second still counts as pending;
+                # anything older is skipped, as is the minute a chat was switched on in.
+                base = max(last_tick, int(time.time() - 1) // 60 * 60)
+                heap, quiet = build_schedule(chats, base)
+            if not heap:
+                await changed.wait()
+                stale = True
+                continue
+
+            tick = heap[0][0]
+            delay = tick - time.time() + TICK_SLACK_S
+            if delay > 0:
+                # Approvals and config edits (interval, auto send) reschedule right away
+                try:
+                    await asyncio.wait_for(changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    stale = True
+                    continue
+
+            due: List[int] = []
+            while heap and heap[0][0] == tick:
+                _, chat_id, interval = heap[0]
+                heapq.heapreplace(heap, (next_due(tick, interval), chat_id, interval))
+                due.append(chat_id)
+            last_tick = tick
+
+            now = datetime.fromtimestamp(tick, TZ)
+            minute = now.hour * 60 + now.minute
+            due = [cid for cid in due if not in_window(minute, quiet[cid])]
+            if not due:
+                continue
+
+            # One upstream fetch per tick, shared by every chat in the fan-out.
+            try:
+                data = await client.fetch()
+            except Exception as e:
+                LOG.exception("sender_loop fetch error: %s", e)
+                continue
+            await asyncio.gather(*(send_one(cid, data) for cid in due))
+    finally:
+        st.on_schedule_change = None
+
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     LOG.exception("Unhandled error", exc_info=context.error)
@@ -927,6 +1587,13 @@ def parse_admin_ids(s: str) -> List[int]:
     return out
 
 
+# Only the update types the handlers above consume. my_chat_member is not sent by
+# default and must be listed explicitly; everything else (edits, channel posts,
+# inline queries, ...) would just be fetched and dropped.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.MY_CHAT_MEMBER]
+POLL_TIMEOUT_S = 30
+
+
 def main() -> None:
     load_dotenv()
 
@@ -934,9 +1601,18 @@ def main() -> None:
     admin_ids_raw = os.getenv("ADMIN_IDS", "").strip()
     db_path = os.getenv("DB_PATH", "").strip() or "/root/bonbast-bot/app/data/bonbast.db"
     log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    # Optional webhook mode (public HTTPS base URL, e.g. behind a reverse proxy)
+    webhook_url = os.getenv("WEBHOOK_URL", "").strip()
+    webhook_listen = os.getenv("WEBHOOK_LISTEN", "").strip() or "0.0.0.0"
+    webhook_port = int(os.getenv("WEBHOOK_PORT", "").strip() or 8443)
+    webhook_secret = os.getenv("WEBHOOK_SECRET", "").strip() or secrets.token_hex(32)
 
     logging.basicConfig(level=getattr(logging, log_level, logging.INFO), format="%(asctime)s | %(levelname)s | %(name)s | %(message)s")
 
+    if uvloop is not None:
+        # run_polling/run_webhook create their loop from the policy
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     if not token:
         raise SystemExit("BOT_TOKEN is missing in .env")
     if not admin_ids_raw:
@@ -945,14 +1621,18 @@ def main() -> None:
     admin_ids = parse_admin_ids(admin_ids_raw)
 
     st = Storage(db_path)
-    client = BonbastClient()
+    client = BonbastClient(param_cache_path=os.path.join(os.path.dirname(db_path), "bonbast_param.json"))
 
-    app = Application.builder().token(token).build()
+    # Updates are handled concurrently; a slow Send now or Bonbast fetch for one chat
+    # doesn't hold up everyone else's taps. chat_lock() serializes per chat.
+    app = Application.builder().token(token).concurrent_updates(True).build()
 
     # Store global objects
-    app.bot_data["ADMIN_IDS"] = admin_ids
+    app.bot_data["ADMIN_IDS"] = admin_ids  # ordered; [0] receives test sends
+    app.bot_data["ADMIN_ID_SET"] = frozenset(admin_ids)
     app.bot_data["STORAGE"] = st
     app.bot_data["CLIENT"] = client
+    app.bot_data["LIMITER"] = RateLimiter()
     # Hack: pass context into sender_loop helper
     app.bot_data["CTX"] = type("X", (), {"bot_data": app.bot_data, "bot": app.bot})()
 
@@ -967,12 +1647,44 @@ def main() -> None:
     app.add_error_handler(on_error)
 
     async def post_init(_: Application) -> None:
-        app.create_task(sender_loop(app))
+        # Not app.create_task(): Application.stop() waits for those tasks, and this
+        # one never finishes on its own, so SIGINT/SIGTERM would hang the shutdown.
+        app.bot_data["SENDER"] = asyncio.create_task(sender_loop(app))
+
+    async def post_stop(_: Application) -> None:
+        # Stop posting before the bot's HTTP session and our storage go away.
+        task = app.bot_data.pop("SENDER", None)
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+    async def post_shutdown(_: Application) -> None:
+        await asyncio.to_thread(st.flush)
+        await client.aclose()
 
     app.post_init = post_init
+    app.post_stop = post_stop
+    app.post_shutdown = post_shutdown
+
+    if webhook_url:
+        # Telegram pushes updates to us; the secret doubles as the URL path and
+        # is checked on every request via X-Telegram-Bot-Api-Secret-Token.
+        LOG.info("Starting bot (webhook on port %s)…", webhook_port)
+        app.run_webhook(
+            listen=webhook_listen,
+            port=webhook_port,
+            url_path=webhook_secret,
+            webhook_url=f"{webhook_url.rstrip('/')}/{webhook_secret}",
+            secret_token=webhook_secret,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        return
 
     LOG.info("Starting bot…")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)  # ensure we get my_chat_member updates
+    # Long polls: Telegram holds each getUpdates open up to POLL_TIMEOUT_S and answers
+    # as soon as an update arrives, so idle periods cost one request per 30 s, not per 10 s.
+    app.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=POLL_TIMEOUT_S)
 
 
 if __name__ == "__main__":
@@ -1,25 +1,85 @@
+import asyncio
+import copy
 import json
+import logging
 import os
 import sqlite3
 import threading
+import zlib
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+LOG = logging.getLogger("bonbast-bot")
 
 
 def _utc_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
+# JSON columns larger than this are stored zlib-compressed as a BLOB.
+COMPRESS_MIN_BYTES = 512
+
+
+def _dump_json(obj: Any) -> Any:
+    if orjson is not None:
+        data = orjson.dumps(obj)
+    else:
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    if len(data) < COMPRESS_MIN_BYTES:
+        return data.decode("utf-8")
+    return zlib.compress(data, 1)
+
+
+def _load_json(value: Any) -> Any:
+    # TEXT rows are plain JSON; BLOB rows were written compressed by _dump_json().
+    if isinstance(value, bytes):
+        value = zlib.decompress(value)
+    if orjson is not None:
+        return orjson.loads(value or "{}")
+    return json.loads(value or "{}")
+
+
 class Storage:
+    # Debounce window for set_config_deferred(): bursts of UI toggles within
+    # this many seconds are written in one transaction.
+    FLUSH_DELAY_S = 0.25
+    # After a failed deferred flush the batch is put back and retried this much later.
+    FLUSH_RETRY_S = 5.0
+
     def __init__(self, db_path: str) -> None:
         self.db_path = db_path
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
         self._lock = threading.RLock()
+        # Serializes SQLite access. Always taken before _lock; every method holds
+        # only this one during its I/O, so the event-loop side (deferred setters,
+        # cached reads) never waits on the disk.
+        self._write_lock = threading.Lock()
+        # Write-through cache of get_chat() rows keyed by chat_id.
+        # Callers always get a copy, so mutating it never leaks into the cache.
+        self._cache: Dict[int, Dict[str, Any]] = {}
+        # True once list_chats() has loaded every row, until a new chat is inserted.
+        self._cache_complete = False
+        # Configs waiting for the debounced flush, keyed by chat_id.
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        # Same for per-chat send state written by the sender loop.
+        self._pending_state: Dict[int, Dict[str, Any]] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Called (from whichever thread wrote) after a change that can move a chat's
+        # send schedule: approval, config or removal. Must be thread-safe.
+        self.on_schedule_change: Optional[Callable[[], None]] = None
         self._init_db()
 
     def _connect(self) -> sqlite3.Connection:
-        con = sqlite3.connect(self.db_path, timeout=30)
+        # Autocommit: every write below is a single statement and must persist on close().
+        con = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
         con.row_factory = sqlite3.Row
+        # Safe with WAL; avoids an fsync per commit.
+        con.execute("PRAGMA synchronous=NORMAL")
         return con
 
     def _table_exists(self, con: sqlite3.Connection, name: str) -> bool:
@@ -112,6 +172,8 @@ class Storage:
         with self._lock:
             con = self._connect()
             try:
+                # WAL lets readers proceed while a write is in flight (persistent per DB file).
+                con.execute("PRAGMA journal_mode=WAL")
                 if not self._table_exists(con, "chats"):
                     self._create_chats_table(con)
                     return
@@ -119,15 +181,54 @@ class Storage:
                 cols = set(self._get_cols(con, "chats"))
                 required = {"chat_id", "title", "type", "approved", "config_json", "state_json", "created_at", "updated_at"}
                 if not required.issubset(cols):
-                    self._rebuild_chats_table(con)
+                    con.execute("BEGIN")
+                    try:
+                        self._rebuild_chats_table(con)
+                    except Exception:
+                        con.execute("ROLLBACK")
+                        raise
+                    con.execute("COMMIT")
             finally:
                 con.close()
 
+    def _update_cached(self, chat_id: int, field: str, value: Any) -> None:
+        ch = self._cache.get(chat_id)
+        if ch is not None:
+            ch[field] = value
+
+    def _schedule_changed(self) -> None:
+        cb = self.on_schedule_change
+        if cb is not None:
+            cb()
+
     # -------- Chat ops --------
+    # SQLite I/O and JSON decoding happen under _write_lock only (reads included,
+    # so a row read from disk can't race a write into the cache). _lock is held
+    # just long enough to read or update _cache/_pending, so the deferred setters
+    # running on the event loop never wait on the disk.
+
+    @staticmethod
+    def _row_to_chat(r: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "chat_id": int(r["chat_id"]),
+            "title": r["title"] or "",
+            "type": r["type"] or "",
+            "approved": int(r["approved"] or 0),
+            "config": _load_json(r["config_json"]),
+            "state": _load_json(r["state_json"]),
+        }
+
+    def _overlay_pending(self, ch: Dict[str, Any]) -> None:
+        # Caller holds _lock.
+        chat_id = ch["chat_id"]
+        if chat_id in self._pending:
+            ch["config"] = copy.deepcopy(self._pending[chat_id])
+        if chat_id in self._pending_state:
+            ch["state"] = copy.deepcopy(self._pending_state[chat_id])
 
     def upsert_chat(self, chat_id: int, title: str, chat_type: str) -> None:
         now = _utc_iso()
-        with self._lock:
+        with self._write_lock:
             con = self._connect()
             try:
                 con.execute(
@@ -143,17 +244,29 @@ class Storage:
                 )
             finally:
                 con.close()
+            with self._lock:
+                ch = self._cache.get(chat_id)
+                if ch is not None:
+                    ch["title"] = title or ""
+                    ch["type"] = chat_type or ""
+                else:
+                    self._cache_complete = False
 
     def remove_chat(self, chat_id: int) -> None:
-        with self._lock:
+        with self._write_lock:
             con = self._connect()
             try:
                 con.execute("DELETE FROM chats WHERE chat_id=?", (chat_id,))
             finally:
                 con.close()
+            with self._lock:
+                self._cache.pop(chat_id, None)
+                self._pending.pop(chat_id, None)
+                self._pending_state.pop(chat_id, None)
+        self._schedule_changed()
 
     def list_chats(self) -> List[Dict[str, Any]]:
-        with self._lock:
+        with self._write_lock:
             con = self._connect()
             try:
                 rows = con.execute(
@@ -163,24 +276,33 @@ class Storage:
                     ORDER BY updated_at DESC
                     """
                 ).fetchall()
-                out: List[Dict[str, Any]] = []
-                for r in rows:
-                    out.append(
-                        {
-                            "chat_id": int(r["chat_id"]),
-                            "title": r["title"] or "",
-                            "type": r["type"] or "",
-                            "approved": int(r["approved"] or 0),
-                            "config": json.loads(r["config_json"] or "{}"),
-                            "state": json.loads(r["state_json"] or "{}"),
-                        }
-                    )
-                return out
             finally:
                 con.close()
+            out = [self._row_to_chat(r) for r in rows]
+            with self._lock:
+                for ch in out:
+                    self._overlay_pending(ch)
+                    self._cache[ch["chat_id"]] = copy.deepcopy(ch)
+                self._cache_complete = True
+            return out
+
+    def list_chats_cached(self) -> List[Dict[str, Any]]:
+        """
+        Like list_chats(), but served from the cache once it holds every row, in
+        no particular order. Rows are shallow copies: their config/state dicts are
+        shared with the cache (which only ever replaces them) and must not be mutated.
+        """
+        with self._lock:
+            if self._cache_complete:
+                return [dict(ch) for ch in self._cache.values()]
+        return self.list_chats()
 
     def get_chat(self, chat_id: int) -> Optional[Dict[str, Any]]:
         with self._lock:
+            cached = self._cache.get(chat_id)
+            if cached is not None:
+                return copy.deepcopy(cached)
+        with self._write_lock:
             con = self._connect()
             try:
                 r = con.execute(
@@ -190,22 +312,23 @@ class Storage:
                     """,
                     (chat_id,),
                 ).fetchone()
-                if not r:
-                    return None
-                return {
-                    "chat_id": int(r["chat_id"]),
-                    "title": r["title"] or "",
-                    "type": r["type"] or "",
-                    "approved": int(r["approved"] or 0),
-                    "config": json.loads(r["config_json"] or "{}"),
-                    "state": json.loads(r["state_json"] or "{}"),
-                }
             finally:
                 con.close()
+            if not r:
+                return None
+            ch = self._row_to_chat(r)
+            with self._lock:
+                cached = self._cache.get(chat_id)
+                if cached is not None:
+                    # Loaded by another reader meanwhile; the cache is at least as fresh
+                    return copy.deepcopy(cached)
+                self._overlay_pending(ch)
+                self._cache[chat_id] = copy.deepcopy(ch)
+            return ch
 
     def set_approved(self, chat_id: int, approved: bool) -> None:
         now = _utc_iso()
-        with self._lock:
+        with self._write_lock:
             con = self._connect()
             try:
                 con.execute(
@@ -214,27 +337,198 @@ class Storage:
                 )
             finally:
                 con.close()
+            with self._lock:
+                self._update_cached(chat_id, "approved", 1 if approved else 0)
+        self._schedule_changed()
+
+    def _config_unchanged(self, chat_id: int, config: Dict[str, Any]) -> bool:
+        # Re-saving what we already hold (e.g. picking the current interval again) is a no-op.
+        ch = self._cache.get(chat_id)
+        return ch is not None and ch["config"] == config
 
     def set_config(self, chat_id: int, config: Dict[str, Any]) -> None:
         now = _utc_iso()
-        with self._lock:
+        with self._write_lock:
+            with self._lock:
+                if self._config_unchanged(chat_id, config):
+                    return
+                # Pending entries are replaced, never mutated: identity tells whether
+                # a deferred config arrived while this write was on disk.
+                before = self._pending.get(chat_id)
+                cached = copy.deepcopy(config)
             con = self._connect()
             try:
                 con.execute(
                     "UPDATE chats SET config_json=?, updated_at=? WHERE chat_id=?",
-                    (json.dumps(config, ensure_ascii=False), now, chat_id),
+                    (_dump_json(config), now, chat_id),
                 )
             finally:
                 con.close()
+            with self._lock:
+                if self._pending.get(chat_id) is before:
+                    self._pending.pop(chat_id, None)
+                    self._update_cached(chat_id, "config", cached)
+        self._schedule_changed()
+
+    def set_config_deferred(self, chat_id: int, config: Dict[str, Any]) -> None:
+        """
+        Like set_config(), but the write is debounced: reads see the new config
+        immediately, and all configs changed within FLUSH_DELAY_S are written
+        together by flush() on a worker thread.
+        Without a running event loop this falls back to an immediate write.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.set_config(chat_id, config)
+            return
+        with self._lock:
+            if self._config_unchanged(chat_id, config):
+                return
+            self._pending[chat_id] = copy.deepcopy(config)
+            self._update_cached(chat_id, "config", copy.deepcopy(config))
+            self._schedule_flush(loop)
+        self._schedule_changed()
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop, delay: Optional[float] = None) -> None:
+        # Caller holds the lock.
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(
+                self.FLUSH_DELAY_S if delay is None else delay, self._start_flush, loop
+            )
+
+    def _start_flush(self, loop: asyncio.AbstractEventLoop) -> None:
+        fut = loop.run_in_executor(None, self.flush)
+        fut.add_done_callback(lambda f: self._flush_done(f, loop))
+
+    def _flush_done(self, fut: "asyncio.Future[None]", loop: asyncio.AbstractEventLoop) -> None:
+        # Runs on the event loop. flush() has put a failed batch back into the
+        # pending dicts; nothing else would write it until the next deferred change.
+        if fut.cancelled() or fut.exception() is None:
+            return
+        LOG.error("Deferred config/state flush failed, retrying in %ss", self.FLUSH_RETRY_S, exc_info=fut.exception())
+        if loop.is_closed():
+            return
+        with self._lock:
+            if self._pending or self._pending_state:
+                self._schedule_flush(loop, self.FLUSH_RETRY_S)
+
+    def flush(self) -> None:
+        """Write all pending deferred configs and states in a single transaction."""
+        with self._write_lock:
+            # Take the batch under the short in-memory lock; pending entries are
+            # private copies that are only ever replaced, never mutated.
+            with self._lock:
+                self._flush_handle = None
+                configs, self._pending = self._pending, {}
+                states, self._pending_state = self._pending_state, {}
+            if not configs and not states:
+                return
+            now = _utc_iso()
+            rows = [(_dump_json(cfg), now, chat_id) for chat_id, cfg in configs.items()]
+            state_rows = [(_dump_json(state), now, chat_id) for chat_id, state in states.items()]
+            con: Optional[sqlite3.Connection] = None
+            try:
+                con = self._connect()
+                con.execute("BEGIN IMMEDIATE")
+                try:
+                    if rows:
+                        con.executemany("UPDATE chats SET config_json=?, updated_at=? WHERE chat_id=?", rows)
+                    if state_rows:
+                        con.executemany("UPDATE chats SET state_json=?, updated_at=? WHERE chat_id=?", state_rows)
+                except Exception:
+                    con.execute("ROLLBACK")
+                    raise
+                con.execute("COMMIT")
+            except Exception:
+                # Put the batch back for the next flush unless newer values arrived meanwhile
+                with self._lock:
+                    for chat_id, cfg in configs.items():
+                        self._pending.setdefault(chat_id, cfg)
+                    for chat_id, state in states.items():
+                        self._pending_state.setdefault(chat_id, state)
+                raise
+            finally:
+                if con is not None:
+                    con.close()
 
     def set_state(self, chat_id: int, state: Dict[str, Any]) -> None:
         now = _utc_iso()
-        with self._lock:
+        with self._write_lock:
+            with self._lock:
+                before = self._pending_state.get(chat_id)
+            cached = copy.deepcopy(state)
             con = self._connect()
             try:
                 con.execute(
                     "UPDATE chats SET state_json=?, updated_at=? WHERE chat_id=?",
-                    (json.dumps(state, ensure_ascii=False), now, chat_id),
+                    (_dump_json(state), now, chat_id),
                 )
             finally:
                 con.close()
+            with self._lock:
+                # Same newer-deferred-write check as set_config()
+                if self._pending_state.get(chat_id) is before:
+                    self._pending_state.pop(chat_id, None)
+                    self._update_cached(chat_id, "state", cached)
+
+    def set_state_deferred(self, chat_id: int, state: Dict[str, Any]) -> None:
+        """
+        Debounced set_state(): a sender-loop tick touching many chats ends up
+        as one transaction instead of one per chat.
+        Without a running event loop this falls back to an immediate write.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.set_state(chat_id, state)
+            return
+        with self._lock:
+            self._pending_state[chat_id] = copy.deepcopy(state)
+            self._update_cached(chat_id, "state", copy.deepcopy(state))
+            self._schedule_flush(loop)
+
+    # -------- Async wrappers --------
+    # SQLite calls block; these run them on a worker thread so the bot's event
+    # loop keeps serving updates. The locks above serialize access.
+
+    async def aget_chat(self, chat_id: int) -> Optional[Dict[str, Any]]:
+        # Cache hits are served in-memory with no thread hop. Only the cache is
+        # touched here: the miss path takes _write_lock, which must never be
+        # acquired while holding _lock.
+        if self._lock.acquire(blocking=False):
+            try:
+                cached = self._cache.get(chat_id)
+                if cached is not None:
+                    return copy.deepcopy(cached)
+            finally:
+                self._lock.release()
+        return await asyncio.to_thread(self.get_chat, chat_id)
+
+    async def alist_chats(self) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.list_chats)
+
+    async def alist_chats_cached(self) -> List[Dict[str, Any]]:
+        # Same no-thread-hop fast path as aget_chat()
+        if self._lock.acquire(blocking=False):
+            try:
+                if self._cache_complete:
+                    return [dict(ch) for ch in self._cache.values()]
+            finally:
+                self._lock.release()
+        return await asyncio.to_thread(self.list_chats_cached)
+
+    async def aupsert_chat(self, chat_id: int, title: str, chat_type: str) -> None:
+        await asyncio.to_thread(self.upsert_chat, chat_id, title, chat_type)
+
+    async def aremove_chat(self, chat_id: int) -> None:
+        await asyncio.to_thread(self.remove_chat, chat_id)
+
+    async def aset_approved(self, chat_id: int, approved: bool) -> None:
+        await asyncio.to_thread(self.set_approved, chat_id, approved)
+
+    async def aset_config(self, chat_id: int, config: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.set_config, chat_id, config)
+
+    async def aset_state(self, chat_id: int, state: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self.set_state, chat_id, state)